@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Import time of the headless core.
+#
+#   python benchmarks/bench_import.py
+#   python benchmarks/bench_import.py --budget-ms 30 --repeat 20
+#
+# Every module is imported in a fresh interpreter. Its own cost is the time
+# over an interpreter that imported only the third party modules it needs,
+# SQLAlchemy alone takes a few hundred ms on a slow machine and is not what
+# this checks. The run fails when the median own cost of a module goes over
+# the budget, or when importing it loads GTK.
+#
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+from timeit import default_timer as timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NOTED = os.path.join(ROOT, 'noted')
+
+SQLALCHEMY = 'sqlalchemy.orm, sqlalchemy.ext.declarative'
+
+# module, what it needs from outside noted
+MODULES = (('core.paths', None),
+           ('core.instrumentation', None),
+           ('core.rich_text', None),
+           ('core.note_format', None),
+           ('core.revisions', None),
+           ('logger.logger', None),
+           ('core.database', SQLALCHEMY))
+
+# exits 3 when the import pulled in gi
+PROGRAM = 'import sys; import {}; sys.exit(3 if "gi" in sys.modules else 0)'
+
+
+def run(code):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([NOTED] + [path for path in [env.get('PYTHONPATH')] if path])
+    start = timer()
+    result = subprocess.call([sys.executable, '-c', code], env=env)
+    return timer() - start, result
+
+
+def median(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of the Noted core.')
+    parser.add_argument('--budget-ms', type=float, default=50.0, help='own import time allowed per module')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    empty = median([run('pass')[0] for _ in range(args.repeat)])
+    baselines = {None: empty}
+    failed = False
+    print('{:<20} {:>10} {:>10}'.format('module', 'total ms', 'own ms'))
+    for module, needs in MODULES:
+        if needs not in baselines:
+            baselines[needs] = median([run('import {}'.format(needs))[0] for _ in range(args.repeat)])
+        baseline = baselines[needs]
+        samples = []
+        for _ in range(args.repeat):
+            elapsed, result = run(PROGRAM.format(module))
+            if result == 3:
+                print('{} imports gi'.format(module))
+                failed = True
+                break
+            if result != 0:
+                print('{} failed to import'.format(module))
+                failed = True
+                break
+            samples.append(elapsed - baseline)
+        else:
+            cost = median(samples) * 1000
+            total = cost + (baseline - empty) * 1000
+            over = cost > args.budget_ms
+            failed = failed or over
+            print('{:<20} {:>10.1f} {:>10.1f}{}'.format(module, total, cost, '  over budget' if over else ''))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
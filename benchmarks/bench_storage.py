@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+#
+# Storage benchmarks, they run without a display.
+#
+#   python benchmarks/bench_storage.py --notebooks 10 --notes 100
+#   python benchmarks/bench_storage.py --notebooks 100 --notes 100 --image-ratio 0.2
+#   python benchmarks/bench_storage.py --compare old.json new.json
+#
+# A synthetic collection is generated (see corpus.py) in a temporary data
+# directory, XDG_DATA_HOME points there so neither the database nor the log of
+# the user is touched. Every scenario is timed against Database and the
+# results are written as JSON together with the commit they were taken at.
+#
+# append_note also checks the revision delta of appending a line to a note,
+# the run fails when a delta is not close to the size of the line.
+#
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'noted'))
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    count = len(samples)
+    if not count:
+        return {'runs': 0}
+    return {'runs': count,
+            'total_ms': sum(samples) * 1000,
+            'mean_ms': sum(samples) * 1000 / count,
+            'min_ms': samples[0] * 1000,
+            'median_ms': samples[count // 2] * 1000,
+            'p95_ms': samples[min(count - 1, int(count * 0.95))] * 1000,
+            'max_ms': samples[-1] * 1000}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def open_database():
+    from core.database import Database
+    database = Database()
+    database.start_database()
+    return database
+
+
+def bench_startup(repeat):
+    # what MainWindow.start_database asks of the storage
+    samples = []
+    for _ in xrange(repeat):
+        start = timer()
+        database = open_database()
+        database.get_notebooks()
+        database.get_notebook_counts()
+        samples.append(timer() - start)
+        database.close_database()
+    return samples
+
+
+def bench_expand_notebook(database, notebook_ids, page_size=200):
+    # every page of the notes of a notebook, the way the sidebar loads them
+    samples = []
+    for notebook_id in notebook_ids:
+        start = timer()
+        after_id = 0
+        while True:
+            page = database.get_note_page(notebook_id, after_id, page_size)
+            if len(page) < page_size:
+                break
+            after_id = page[-1][0]
+        samples.append(timer() - start)
+    return samples
+
+
+def bench_get_note(database, note_ids):
+    samples = []
+    for note_id in note_ids:
+        start = timer()
+        database.get_note_content(note_id)
+        samples.append(timer() - start)
+    return samples
+
+
+def bench_modify_note(database, note_ids):
+    samples = []
+    for note_id in note_ids:
+        content = database.get_note_content(note_id)
+        start = timer()
+        database.modify_note('Modified {}'.format(note_id), content, note_id)
+        samples.append(timer() - start)
+    return samples
+
+
+def bench_append_note(database, note_ids, line=u'One more line at the end.\n'):
+    # returns the samples and the largest revision delta of an append
+    from core import note_format, revisions
+    samples = []
+    largest = 0
+    for note_id in note_ids:
+        content = database.get_note_content(note_id)
+        note = note_format.loads(content)
+        appended = note_format.dumps(note_format.Note(note.text + line, note.spans, note.images))
+        largest = max(largest, len(revisions.make_delta(content, appended)))
+        start = timer()
+        database.modify_note('Appended {}'.format(note_id), appended, note_id)
+        samples.append(timer() - start)
+    return samples, largest
+
+
+def bench_delete_notebook(database, notebook_ids):
+    samples = []
+    for notebook_id in notebook_ids:
+        start = timer()
+        database.delete_notebook(notebook_id)
+        samples.append(timer() - start)
+    return samples
+
+
+def bench_restore_note(database, note_ids):
+    samples = []
+    for note_id in note_ids:
+        start = timer()
+        database.restore_note(note_id)
+        samples.append(timer() - start)
+    return samples
+
+
+def run(args):
+    import corpus
+    data_dir = os.path.join(os.environ['XDG_DATA_HOME'], 'Noted')
+    db_path = os.path.join(data_dir, 'sqlitedatabase.db')
+    rng = random.Random(args.seed)
+
+    database = open_database()
+    start = timer()
+    generated = corpus.generate(database, notebooks=args.notebooks, notes=args.notes,
+                                paragraphs=args.paragraphs, image_ratio=args.image_ratio,
+                                images_per_note=args.images_per_note,
+                                unique_images=args.unique_images, seed=args.seed)
+    generated['generation_s'] = timer() - start
+    generated['database_bytes'] = os.path.getsize(db_path)
+    database.close_database()
+
+    scenarios = {}
+    scenarios['startup_listing'] = summarize(bench_startup(args.repeat))
+
+    database = open_database()
+    listing = database.get_note_listing()
+    note_ids = [note_id for note_id, name, notebook_id in listing]
+    sample = rng.sample(note_ids, min(args.sample, len(note_ids)))
+    scenarios['get_note'] = summarize(bench_get_note(database, sample))
+    scenarios['modify_note'] = summarize(bench_modify_note(database, sample))
+    samples, largest = bench_append_note(database, sample)
+    scenarios['append_note'] = summarize(samples)
+    scenarios['append_note']['max_delta_bytes'] = largest
+
+    notebook_ids = [notebook.idd for notebook in database.get_notebooks() if notebook.idd != database.get_trash_id()]
+    scenarios['expand_notebook'] = summarize(bench_expand_notebook(database, notebook_ids))
+    deleted = rng.sample(notebook_ids, min(args.repeat, len(notebook_ids)))
+    scenarios['delete_notebook'] = summarize(bench_delete_notebook(database, deleted))
+
+    trashed = [note_id for note_id, name, notebook_id in listing if notebook_id in deleted]
+    restored = rng.sample(trashed, min(args.sample, len(trashed)))
+    scenarios['restore_note'] = summarize(bench_restore_note(database, restored))
+    database.close_database()
+
+    import sqlite3
+    return {'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'corpus': generated,
+            'final_database_bytes': os.path.getsize(db_path),
+            'scenarios': scenarios}
+
+
+def compare(old_path, new_path):
+    with open(old_path) as old_file:
+        old = json.load(old_file)
+    with open(new_path) as new_file:
+        new = json.load(new_file)
+    print('{:<18} {:>12} {:>12} {:>8}'.format('median ms', old['commit'][:10] if old['commit'] else 'old',
+                                             new['commit'][:10] if new['commit'] else 'new', 'change'))
+    for name in sorted(new['scenarios']):
+        before = old['scenarios'].get(name, {}).get('median_ms')
+        after = new['scenarios'][name].get('median_ms')
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        print('{:<18} {:>12.3f} {:>12.3f} {:>+7.1f}%'.format(name, before, after, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Noted storage layer.')
+    parser.add_argument('--notebooks', type=int, default=10)
+    parser.add_argument('--notes', type=int, default=100, help='notes per notebook')
+    parser.add_argument('--paragraphs', type=int, default=8, help='paragraphs per note')
+    parser.add_argument('--image-ratio', type=float, default=0.0, help='share of notes with images')
+    parser.add_argument('--images-per-note', type=int, default=3)
+    parser.add_argument('--unique-images', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5, help='runs of startup and notebooks deleted')
+    parser.add_argument('--sample', type=int, default=200, help='notes read, modified and restored')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--keep', action='store_true', help='keep the generated data directory')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # some modules read XDG_DATA_HOME when they are imported, it is set before any noted import
+    data_home = tempfile.mkdtemp(prefix='noted-bench-')
+    os.environ['XDG_DATA_HOME'] = data_home
+    os.makedirs(os.path.join(data_home, 'Noted'))
+    try:
+        results = run(args)
+    finally:
+        if args.keep:
+            print('Data kept in {}'.format(data_home))
+        else:
+            shutil.rmtree(data_home)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=1, sort_keys=True)
+    for name in sorted(results['scenarios']):
+        scenario = results['scenarios'][name]
+        print('{:<18} runs {:>5}  median {:>9.3f} ms  p95 {:>9.3f} ms'.format(
+            name, scenario['runs'], scenario.get('median_ms', 0), scenario.get('p95_ms', 0)))
+    print('Results written to {}'.format(args.output))
+    # the line, the lengths before it and the section headers of the delta
+    largest = results['scenarios']['append_note']['max_delta_bytes']
+    if largest > 128:
+        print('append_note: a delta of {} bytes for a line of 26'.format(largest))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
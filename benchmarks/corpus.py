@@ -0,0 +1,103 @@
+#
+# Synthetic note collections for the benchmarks.
+#
+# The notes are written in the note format the editor saves, with bold
+# runs, titles and optional images, through the storage code of Database
+# so that image dedup and the search index are included.
+# The same seed always gives the same collection.
+#
+import random
+from core import rich_text
+from core import note_format
+from core import migrations
+from core.database_tables import Note
+
+WORDS = (u'note meeting idea project list todo remember call email draft review '
+         u'plan budget design release test build fix issue question answer '
+         u'summary detail context owner deadline week month priority status '
+         u'caf\xe9 na\xefve r\xe9sum\xe9').split()
+
+
+def make_image(rng, width, height):
+    # a noisy gradient, compresses about as well as a screenshot
+    rows = []
+    for y in xrange(height):
+        shade = (y * 255) // max(height - 1, 1)
+        noise = bytearray(rng.getrandbits(8) & 0x1f for _ in xrange(16))
+        row = bytearray(width * 4)
+        for x in xrange(width):
+            offset = x * 4
+            row[offset] = shade
+            row[offset + 1] = (x * 255) // max(width - 1, 1)
+            row[offset + 2] = noise[x % 16]
+            row[offset + 3] = 255
+        rows.append(bytes(row))
+    return rich_text.make_pixdata(width, height, ''.join(rows))
+
+
+def make_sentence(rng, words):
+    return u' '.join(rng.choice(WORDS) for _ in xrange(words))
+
+
+def make_note(rng, paragraphs, images):
+    # returns (title, serialized content)
+    title = make_sentence(rng, 3).capitalize()
+    parts = [title, u'\n']
+    spans = [('title', 0, len(title))]
+    length = len(title) + 1
+    note_images = []
+    for paragraph in xrange(paragraphs):
+        before = make_sentence(rng, rng.randint(20, 80)) + u' '
+        bold = make_sentence(rng, 2)
+        after = u' ' + make_sentence(rng, rng.randint(5, 30)) + u'\n'
+        spans.append(('bold', length + len(before), length + len(before) + len(bold)))
+        parts.extend((before, bold, after))
+        length += len(before) + len(bold) + len(after)
+        if len(note_images) < len(images):
+            parts.append(note_format.IMAGE + u'\n')
+            note_images.append(images[len(note_images)])
+            length += 2
+    return title, note_format.dumps(note_format.Note(u''.join(parts), spans, note_images))
+
+
+def generate(database, notebooks=10, notes=100, paragraphs=8, image_ratio=0.0,
+             images_per_note=3, unique_images=20, image_size=(320, 240),
+             seed=1, batch=500):
+    # fills an empty database with `notebooks` notebooks of `notes` notes each
+    # plus the Trash. image_ratio of the notes get images_per_note images picked
+    # from a pool of unique_images, the way screenshots get pasted around.
+    # returns a summary of what was generated
+    rng = random.Random(seed)
+    pool = []
+    if image_ratio > 0:
+        pool = [make_image(rng, image_size[0], image_size[1]) for _ in xrange(unique_images)]
+    database.create_notebook('Trash', 1, migrations.TRASH)
+    note_id = 1
+    content_bytes = 0
+    image_notes = 0
+    for notebook_id in xrange(2, notebooks + 2):
+        database.create_notebook(make_sentence(rng, 2).capitalize(), notebook_id)
+        for _ in xrange(notes):
+            images = []
+            if pool and rng.random() < image_ratio:
+                images = [rng.choice(pool) for _ in xrange(images_per_note)]
+                image_notes += 1
+            title, content = make_note(rng, paragraphs, images)
+            content_bytes += len(content)
+            note = Note(name=title, idd=note_id, notebook_id=notebook_id)
+            database.session.add(note)
+            database.set_content(note, content)
+            note_id += 1
+            if note_id % batch == 0:
+                database.session.commit()
+    database.session.commit()
+    return {'notebooks': notebooks,
+            'notes_per_notebook': notes,
+            'notes': note_id - 1,
+            'paragraphs': paragraphs,
+            'image_notes': image_notes,
+            'images_per_note': images_per_note,
+            'unique_images': len(pool),
+            'image_size': list(image_size),
+            'serialized_bytes': content_bytes,
+            'seed': seed}
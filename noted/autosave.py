@@ -0,0 +1,99 @@
+from gi.repository import GLib
+from logger import logger as lg
+import worker
+
+
+class DirtyTracker(object):
+    # Counts the edits made to every note. A save remembers the count it
+    # was taken at, so edits made while the save was running keep the
+    # note dirty.
+
+    def __init__(self):
+        self.edits = {}
+        self.saved = {}
+
+    def mark(self, note_id):
+        self.edits[note_id] = self.edits.get(note_id, 0) + 1
+
+    def generation(self, note_id):
+        return self.edits.get(note_id, 0)
+
+    def is_dirty(self, note_id):
+        return self.edits.get(note_id, 0) != self.saved.get(note_id, 0)
+
+    def dirty_ids(self):
+        return [note_id for note_id in self.edits if self.is_dirty(note_id)]
+
+    def mark_clean(self, note_id, generation):
+        if generation > self.saved.get(note_id, 0):
+            self.saved[note_id] = generation
+
+    def forget(self, note_id):
+        self.edits.pop(note_id, None)
+        self.saved.pop(note_id, None)
+
+
+class Autosave(object):
+    # Saves the note shown in the editor once the user stops typing for
+    # `delay` milliseconds. The buffer is serialized on the main thread,
+    # the database commit runs on a worker thread with its own session.
+
+    logger = lg.Logger('Autosave')
+
+    def __init__(self, window, delay=1500):
+        self.window = window
+        self.delay = delay
+        self.tracker = DirtyTracker()
+        self.timeout_id = None
+        self.worker = worker.Worker(window.database.fork, close_database)
+        self.worker.start()
+
+    def schedule(self, editor, note_id):
+        # every edit pushes the save back, a burst of edits ends up as one save
+        self.tracker.mark(note_id)
+        self.cancel_timeout()
+        self.timeout_id = GLib.timeout_add(self.delay, self.on_timeout)
+
+    def cancel_timeout(self):
+        if self.timeout_id is not None:
+            GLib.source_remove(self.timeout_id)
+            self.timeout_id = None
+
+    def on_timeout(self):
+        self.timeout_id = None
+        self.flush()
+        return False
+
+    @lg.logging_decorator(logger)
+    def flush(self):
+        # saves every note with unsaved edits that still has a buffer right
+        # away, the one in the editor and cached ones an image was decoded into
+        self.cancel_timeout()
+        for note_id in self.tracker.dirty_ids():
+            snapshot = self.window.get_note_snapshot(note_id)
+            if snapshot is None:
+                continue
+            title, content = snapshot
+            generation = self.tracker.generation(note_id)
+            self.worker.submit(save_note, (note_id, title, content, generation), self.on_saved)
+
+    def on_saved(self, result):
+        note_id, generation = result
+        self.tracker.mark_clean(note_id, generation)
+        # the buffer may have been kept over the size of the cache
+        self.window.editor.buffer_cache.evict()
+        return False
+
+    @lg.logging_decorator(logger)
+    def stop(self):
+        self.flush()
+        self.worker.stop()
+
+
+def save_note(database, note_id, title, content, generation):
+    database.modify_note(title, content, note_id)
+    return note_id, generation
+
+
+def close_database(database):
+    database.close_database()
@@ -0,0 +1,58 @@
+import collections
+
+
+class BufferCache(object):
+    # Least recently used Gtk.TextBuffers of notes, ready to be shown.
+    # Every buffer is kept with its size, the length of the serialized note,
+    # and the oldest buffers are dropped once the sizes go over max_bytes.
+    # keep(note_id, buffer) is True for a buffer that can not be dropped
+    # yet, one with unsaved edits or images still decoding. The cache goes
+    # over max_bytes until evict is called once they can be dropped.
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, keep=None):
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.size = 0
+        self.buffers = collections.OrderedDict()
+
+    def __contains__(self, note_id):
+        return note_id in self.buffers
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def put(self, note_id, buf, size):
+        self.invalidate(note_id)
+        self.buffers[note_id] = (buf, size)
+        self.size += size
+        self.evict()
+
+    def evict(self):
+        # drops the oldest buffers until the sizes fit
+        for note_id in list(self.buffers):
+            if self.size <= self.max_bytes:
+                return
+            buf, size = self.buffers[note_id]
+            if self.keep is None or not self.keep(note_id, buf):
+                del self.buffers[note_id]
+                self.size -= size
+
+    def peek(self, note_id):
+        # the buffer of the note without using it, None if it is not cached
+        entry = self.buffers.get(note_id)
+        return entry[0] if entry is not None else None
+
+    def pop(self, note_id):
+        # returns (buffer, size) and takes it out of the cache, the buffer of
+        # the note being edited is not kept in here. None if it is not cached
+        entry = self.buffers.pop(note_id, None)
+        if entry is not None:
+            self.size -= entry[1]
+        return entry
+
+    def invalidate(self, note_id):
+        self.pop(note_id)
+
+    def clear(self):
+        self.buffers.clear()
+        self.size = 0
@@ -0,0 +1,7 @@
+#
+# Headless core of Noted: notes, notebooks, the trash and their storage.
+#
+# Nothing in here imports GTK, the modules need the standard library and
+# SQLAlchemy only. This file imports none of them, a tool that only needs
+# rich_text or paths doesn't pay for loading SQLAlchemy.
+#
@@ -0,0 +1,63 @@
+#
+# The noted command.
+#
+#   noted import DIRECTORY      adds the Markdown and text files of a tree
+#   noted export DIRECTORY      writes every notebook as a directory of .md
+#
+# Noted should be closed while notes are imported, it keeps the next ids in
+# memory while it runs.
+#
+from __future__ import print_function
+import argparse
+import logging
+import transfer
+
+
+def open_database():
+    from database import Database
+    database = Database()
+    database.start_database()
+    return database
+
+
+def run_import(args):
+    pool = transfer.make_pool(args.processes)
+    database = open_database()
+    try:
+        count = transfer.import_tree(database, pool, args.directory, args.window)
+    finally:
+        pool.close()
+        pool.join()
+        database.close_database()
+    print('Imported {} notes'.format(count))
+
+
+def run_export(args):
+    pool = transfer.make_pool(args.processes)
+    database = open_database()
+    try:
+        count = transfer.export_tree(database, pool, args.directory, args.trash, args.window)
+    finally:
+        pool.close()
+        pool.join()
+        database.close_database()
+    print('Exported {} notes'.format(count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='noted', description='Import and export Noted notes.')
+    subparsers = parser.add_subparsers()
+    for name, function, help_text in (('import', run_import, 'add a directory of Markdown and text files'),
+                                      ('export', run_export, 'write the notebooks as directories of Markdown files')):
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.add_argument('directory')
+        subparser.add_argument('--processes', type=int, default=None, help='conversion processes, one per CPU by default')
+        subparser.add_argument('--window', type=int, default=transfer.WINDOW, help='notes converted and written together')
+        if name == 'export':
+            subparser.add_argument('--trash', action='store_true', help='export the Trash as well')
+        subparser.set_defaults(function=function)
+    args = parser.parse_args(argv)
+    # the core only logs, where to is up to the entry point
+    logging.basicConfig(level=logging.WARNING, format='noted: %(levelname)s: %(message)s')
+    args.function(args)
+    return 0
@@ -0,0 +1,37 @@
+#
+# Codec of the stored note content.
+#
+# The first byte says how the rest is stored, RAW or ZLIB. Contents that
+# don't get smaller are kept RAW. Rows written before the codec existed are
+# text, their first character is the 'G' of the tagset header so they are
+# never mistaken for encoded ones.
+#
+import zlib
+
+RAW = '\x00'
+ZLIB = '\x01'
+LEVEL = 6
+
+
+def encode(data):
+    compressed = zlib.compress(data, LEVEL)
+    if len(compressed) < len(data):
+        return ZLIB + compressed
+    return RAW + data
+
+
+def decode(value):
+    if isinstance(value, unicode):
+        # a row that was not migrated yet
+        return value.encode('iso-8859-1')
+    value = str(value)
+    header = value[:1]
+    if header == ZLIB:
+        return zlib.decompress(value[1:])
+    if header == RAW:
+        return value[1:]
+    raise ValueError('unknown content codec {!r}'.format(header))
+
+
+def is_encoded(value):
+    return value is not None and not isinstance(value, unicode)
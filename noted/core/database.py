@@ -0,0 +1,703 @@
+from sqlalchemy import text, select, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, undefer
+from sqlalchemy.orm.attributes import flag_modified
+from database_tables import Notebook, Note, Image, NoteImage, NoteRevision, Base
+import collections
+import subprocess
+import re
+import zlib
+import sqlite3
+import datetime
+import time
+import logging
+import rich_text
+import note_format
+import codec
+import revisions
+import migrations
+import sqlite_profile
+import paths
+import instrumentation
+
+# ids per IN (...), sqlite allows 999 bound parameters in a statement
+CHUNK_SIZE = 500
+# what a notebook named like the Trash is imported as, the notes of an
+# exported Trash don't know the notebooks they were deleted from
+IMPORTED_TRASH_NAME = u'{} (imported)'
+INDEX_NOTE = text("INSERT OR REPLACE INTO note_fts(rowid, name, body, notebook_id) VALUES (:idd, :name, :body, :notebook_id)")
+
+logger = logging.getLogger(__name__)
+timed = instrumentation.instrumented('Database', logger)
+
+def is_titled(name,body):
+	# whether the name of a note was taken from its first line, the way the
+	# window names notes. modify_note stores the utf-8 title decoded as latin-1
+	title = note_format.get_title(body)
+	return name in (title, title.encode('utf-8').decode('iso-8859-1'))
+
+def chunks(ids):
+	ids = list(ids)
+	for start in xrange(0, len(ids), CHUNK_SIZE):
+		yield ids[start:start + CHUNK_SIZE]
+
+class Database(object):
+
+	@timed
+	def start_database(self):
+		paths.data_dir(create=True)
+		db_path = paths.database_path()
+		# journal mode, syncs and caches are set by the storage profile
+		self.engine = sqlite_profile.open_engine(db_path)
+		# only creates the tables that are missing, the migrations change the
+		# existing ones
+		Base.metadata.create_all(self.engine)
+		migrations.migrate(self.engine)
+		Base.metadata.bind = self.engine
+		DBSession = sessionmaker(bind=self.engine)
+		self.session = DBSession()
+		self.trash_id = None
+		self.create_search_index()
+
+	@timed
+	def create_search_index(self):
+		# FTS5 table next to the note table, the rowid is the note id. The
+		# notes saved before it was created are added by index_all_contents
+		# in the background, until search_indexed is set search falls back
+		# to the titles
+		exists = self.session.execute(text("SELECT name FROM sqlite_master WHERE type='table' AND name='note_fts'")).first()
+		self.search_enabled = True
+		self.search_indexed = False
+		if exists:
+			return
+		try:
+			self.session.execute(text("CREATE VIRTUAL TABLE note_fts USING fts5(name, body, notebook_id UNINDEXED)"))
+		except OperationalError:
+			# sqlite was built without FTS5, search falls back to the titles
+			self.session.rollback()
+			self.search_enabled = False
+			return
+		self.session.commit()
+
+	@timed
+	def fork(self):
+		# a second Database on the same engine, to be used from another thread.
+		# a session must never be shared between threads
+		database = Database()
+		database.engine = self.engine
+		database.session = sessionmaker(bind=self.engine)()
+		database.search_enabled = self.search_enabled
+		database.search_indexed = self.search_indexed
+		database.trash_id = self.trash_id
+		return database
+
+	@timed
+	def close_database(self):
+		self.session.close()
+
+	@timed
+	def maintain(self,final=False):
+		# checkpoint and optimize, see sqlite_profile. final when closing
+		sqlite_profile.maintain(self.engine,final)
+
+	@timed
+	def create_note(self,name,content,idd,notebook_id):
+		try:
+			note = Note(name=unicode(name,'iso-8859-1'),idd = idd,notebook_id = notebook_id)
+		except TypeError:
+			note = Note(name=name,idd=idd,notebook_id=notebook_id)
+		self.session.add(note)
+		self.set_content(note,content)
+		self.add_revision(note)
+		self.session.commit()
+
+	@timed
+	def set_content(self,note,content,titled=True):
+		# titled is False when the name of the note is not its first line
+		# images are stored once in the image table, keyed by their hash.
+		# the note keeps a reference to every image in place of the pixel data
+		new_images = {}
+		data, digests = self.split_content(content,new_images)
+		self.store_images(new_images)
+		# images dropped from the note stay referenced for its revisions,
+		# prune_revisions recomputes the references
+		referenced = self.session.query(NoteImage.digest).filter_by(note_id=note.idd).all()
+		for digest in set(digests) - set(digest for digest, in referenced):
+			self.session.add(NoteImage(note_id=note.idd,digest=digest))
+		body = self.fill_content(note,data,digests,titled)
+		self.index_note(note.idd,note.name,note.notebook_id,body)
+
+	def split_content(self,content,new_images):
+		# returns the content without its images and the digest of every
+		# image, the pixel data of the images is added to new_images
+		data, images = note_format.split_images(content)
+		digests = []
+		for image in images:
+			if rich_text.is_reference(image):
+				digest = rich_text.reference_digest(image)
+			else:
+				digest = rich_text.image_digest(image)
+				new_images[digest] = image
+			digests.append(digest)
+		return data, digests
+
+	def store_images(self,new_images):
+		# adds the images of {digest: pixel data} that are not stored yet
+		if not new_images:
+			return
+		stored = self.session.query(Image.digest).filter(Image.digest.in_(new_images.keys())).all()
+		for digest, in stored:
+			del new_images[digest]
+		for digest in new_images:
+			width, height = rich_text.pixdata_size(new_images[digest])
+			self.session.add(Image(digest=digest,data=zlib.compress(new_images[digest]),width=width,height=height))
+
+	def fill_content(self,note,data,digests,titled):
+		# sets the content and the summary columns of note, returns its plain text
+		references = [rich_text.make_reference(digest) for digest in digests]
+		note.content = note_format.join_images(data,references)
+		body = note_format.plain_text(data)
+		note.plain_text = body
+		note.preview, note.char_count, note.word_count = note_format.summarize(body,titled)
+		return body
+
+	@timed
+	def index_note(self,idd,name,notebook_id,body):
+		# body is the plain text of the note
+		if self.search_enabled:
+			self.session.execute(INDEX_NOTE,{'idd': idd, 'name': name, 'body': body, 'notebook_id': notebook_id})
+
+	@timed
+	def move_in_index(self,note_ids,notebook_id):
+		if self.search_enabled and note_ids:
+			self.session.execute(text("UPDATE note_fts SET notebook_id = :notebook_id WHERE rowid IN ({})".format(','.join(str(int(idd)) for idd in note_ids))),
+				{'notebook_id': notebook_id})
+
+	@timed
+	def remove_from_index(self,note_ids):
+		if self.search_enabled and note_ids:
+			self.session.execute(text("DELETE FROM note_fts WHERE rowid IN ({})".format(','.join(str(int(idd)) for idd in note_ids))))
+
+	@timed
+	def search(self,query,limit=50):
+		# returns (note id, notebook id, title, snippet) of the best matches,
+		# best first. every word of the query is matched as a prefix
+		words = re.findall(r'\w+', query, re.UNICODE)
+		if not words:
+			return []
+		if not self.search_enabled or not self.search_indexed:
+			notes = self.session.query(Note.idd, Note.notebook_id, Note.name, Note.preview)
+			for word in words:
+				notes = notes.filter(Note.name.like(u'%{}%'.format(word)))
+			return notes.limit(limit).all()
+		match = u' '.join(u'"{}"*'.format(word) for word in words)
+		results = self.session.execute(text("SELECT rowid, notebook_id, name, snippet(note_fts, -1, '', '', '...', 12) FROM note_fts "
+			"WHERE note_fts MATCH :match ORDER BY rank LIMIT :limit"), {'match': match, 'limit': limit})
+		return results.fetchall()
+
+	@timed
+	def encode_contents(self,batch=200):
+		# rewrites notes stored before the content codec, returns how many.
+		# sqlite knows them by their TEXT type, the codec stores blobs
+		note_ids = [idd for idd, in self.session.execute(text("SELECT idd FROM note WHERE typeof(content) = 'text' LIMIT :batch"),
+			{'batch': batch})]
+		if not note_ids:
+			return 0
+		for note in self.session.query(Note).filter(Note.idd.in_(note_ids)).options(undefer('content')):
+			# the value was decoded on load, flagging it writes it encoded
+			flag_modified(note,'content')
+		self.session.commit()
+		return len(note_ids)
+
+	@timed
+	def encode_all_contents(self,stop,pause=0.05):
+		# background job, stop is a threading.Event set when the application
+		# closes. A pause between batches leaves room for the saves
+		total = 0
+		while not stop.is_set():
+			count = self.encode_contents()
+			if not count:
+				return True
+			total += count
+			time.sleep(pause)
+		return False
+
+	@timed
+	def convert_contents(self,after_id=0,batch=200):
+		# rewrites the notes after after_id that are still GTK tagsets in the
+		# note format. Returns the last id looked at, None when there are no
+		# more notes. A note saved in the meantime is left as it was saved
+		rows = self.session.execute(text("SELECT idd, content FROM note WHERE idd > :after_id ORDER BY idd LIMIT :batch"),
+			{'after_id': after_id, 'batch': batch}).fetchall()
+		if not rows:
+			return None
+		for idd, value in rows:
+			if value is None:
+				continue
+			content = codec.decode(value)
+			if not content.startswith(rich_text.HEADER):
+				continue
+			converted = note_format.dumps(note_format.from_tagset(content))
+			self.session.execute(text("UPDATE note SET content = :content WHERE idd = :idd AND content = :old"),
+				{'content': sqlite3.Binary(codec.encode(converted)), 'idd': idd, 'old': value})
+		self.session.commit()
+		return rows[-1][0]
+
+	@timed
+	def convert_all_contents(self,stop,pause=0.05):
+		# background job like encode_all_contents, returns True once every
+		# note is in the note format
+		after_id = 0
+		while not stop.is_set():
+			after_id = self.convert_contents(after_id)
+			if after_id is None:
+				return True
+			time.sleep(pause)
+		return False
+
+	@timed
+	def index_contents(self,after_id=0,batch=200):
+		# adds the notes after after_id that are not in the search index yet.
+		# Returns the last id looked at, None when there are no more notes.
+		# A note saved in the meantime was indexed by set_content and is
+		# left as it was indexed
+		if not self.search_enabled:
+			return None
+		rows = self.session.execute(text("SELECT idd, name, notebook_id, content FROM note WHERE idd > :after_id ORDER BY idd LIMIT :batch"),
+			{'after_id': after_id, 'batch': batch}).fetchall()
+		if not rows:
+			return None
+		for idd, name, notebook_id, value in rows:
+			body = note_format.plain_text(codec.decode(value) if value is not None else None)
+			self.session.execute(text("INSERT INTO note_fts(rowid, name, body, notebook_id) SELECT :idd, :name, :body, :notebook_id "
+				"WHERE NOT EXISTS (SELECT 1 FROM note_fts WHERE rowid = :idd)"),
+				{'idd': idd, 'name': name, 'body': body, 'notebook_id': notebook_id})
+		self.session.commit()
+		return rows[-1][0]
+
+	@timed
+	def index_all_contents(self,stop,pause=0.05):
+		# background job like encode_all_contents, returns True once every
+		# note is in the search index
+		after_id = 0
+		while not stop.is_set():
+			after_id = self.index_contents(after_id)
+			if after_id is None:
+				return True
+			time.sleep(pause)
+		return False
+
+	@timed
+	def summarize_contents(self,batch=200):
+		# fills in the plain text, preview and counts of notes saved before
+		# they were kept, returns how many. A note saved in the meantime got
+		# them from set_content and is left alone
+		rows = self.session.execute(text("SELECT idd, name, content FROM note WHERE char_count IS NULL LIMIT :batch"),
+			{'batch': batch}).fetchall()
+		for idd, name, value in rows:
+			body = note_format.plain_text(codec.decode(value) if value is not None else None)
+			preview, char_count, word_count = note_format.summarize(body,is_titled(name,body))
+			self.session.execute(text("UPDATE note SET plain_text = :plain_text, preview = :preview, char_count = :char_count, "
+				"word_count = :word_count WHERE idd = :idd AND char_count IS NULL"),
+				{'plain_text': body, 'preview': preview, 'char_count': char_count, 'word_count': word_count, 'idd': idd})
+		self.session.commit()
+		return len(rows)
+
+	@timed
+	def summarize_all_contents(self,stop,pause=0.05):
+		# background job like encode_all_contents, returns True once every
+		# note has its summary
+		while not stop.is_set():
+			if not self.summarize_contents():
+				return True
+			time.sleep(pause)
+		return False
+
+	@timed
+	def load_images(self,digests):
+		# returns {digest: GdkPixdata} in one query
+		images = self.session.query(Image.digest, Image.data).filter(Image.digest.in_(digests)).all()
+		return dict((digest, zlib.decompress(data)) for digest, data in images)
+
+	@timed
+	def add_revision(self,note):
+		# records the stored content of note as its newest revision
+		content = note.content
+		last = self.session.query(NoteRevision).filter_by(note_id=note.idd).order_by(NoteRevision.number.desc()).first()
+		now = datetime.datetime.utcnow()
+		if last is None:
+			self.session.add(NoteRevision(note_id=note.idd,number=1,keyframe=True,created=now,data=revisions.encode(content)))
+			return
+		previous = self.get_revision_data(note.idd,last.number)
+		if previous == content:
+			return
+		if not last.keyframe and (now - last.created).total_seconds() < revisions.COALESCE_SECONDS:
+			# a burst of saves ends up as one revision
+			base = self.get_revision_data(note.idd,last.number - 1)
+			last.data = revisions.encode(revisions.make_delta(base,content))
+			last.created = now
+			return
+		keyframe_number = self.session.query(NoteRevision.number).filter_by(note_id=note.idd,keyframe=True).order_by(NoteRevision.number.desc()).limit(1).scalar()
+		number = last.number + 1
+		delta = revisions.make_delta(previous,content)
+		if number - keyframe_number >= revisions.KEYFRAME_INTERVAL or len(delta) * 2 > len(content):
+			revision = NoteRevision(note_id=note.idd,number=number,keyframe=True,created=now,data=revisions.encode(content))
+		else:
+			revision = NoteRevision(note_id=note.idd,number=number,keyframe=False,created=now,data=revisions.encode(delta))
+		self.session.add(revision)
+		self.prune_revisions(note.idd,number)
+
+	@timed
+	def get_revision_data(self,note_id,number):
+		# rebuilds the stored content of a revision from the keyframe before it
+		keyframe_number, data = self.session.query(NoteRevision.number, NoteRevision.data).filter(
+			NoteRevision.note_id == note_id, NoteRevision.keyframe == True, NoteRevision.number <= number).order_by(
+			NoteRevision.number.desc()).first()
+		content = revisions.decode(data)
+		deltas = self.session.query(NoteRevision.data).filter(NoteRevision.note_id == note_id,
+			NoteRevision.number > keyframe_number, NoteRevision.number <= number).order_by(NoteRevision.number)
+		for delta, in deltas:
+			content = revisions.apply_delta(content,revisions.decode(delta))
+		return content
+
+	@timed
+	def prune_revisions(self,note_id,last_number):
+		# keeps the newest MAX_REVISIONS revisions, the oldest one kept becomes a keyframe
+		first_kept = last_number - revisions.MAX_REVISIONS + 1
+		oldest = self.session.query(NoteRevision).filter_by(note_id=note_id).order_by(NoteRevision.number).first()
+		if oldest.number > first_kept - revisions.PRUNE_BATCH:
+			return
+		first = self.session.query(NoteRevision).filter_by(note_id=note_id,number=first_kept).one()
+		if not first.keyframe:
+			first.data = revisions.encode(self.get_revision_data(note_id,first_kept))
+			first.keyframe = True
+		self.session.query(NoteRevision).filter(NoteRevision.note_id == note_id,
+			NoteRevision.number < first_kept).delete(synchronize_session=False)
+		# images only the pruned revisions used are no longer referenced
+		digests = set()
+		content = None
+		for keyframe, data in self.session.query(NoteRevision.keyframe, NoteRevision.data).filter_by(note_id=note_id).order_by(NoteRevision.number):
+			if keyframe:
+				content = revisions.decode(data)
+			else:
+				content = revisions.apply_delta(content,revisions.decode(data))
+			data, images = note_format.split_images(content)
+			digests.update(rich_text.reference_digest(image) for image in images if rich_text.is_reference(image))
+		stale = self.session.query(NoteImage).filter(NoteImage.note_id == note_id)
+		if digests:
+			stale = stale.filter(~NoteImage.digest.in_(digests))
+		stale.delete(synchronize_session=False)
+		self.collect_images()
+
+	@timed
+	def get_revisions(self,note_id):
+		# (number, created) of the revisions of a note, newest first
+		return self.session.query(NoteRevision.number, NoteRevision.created).filter_by(note_id=note_id).order_by(NoteRevision.number.desc()).all()
+
+	@timed
+	def get_revision_content(self,note_id,number):
+		# the content of a revision the way get_note_content returns it
+		return self.join_images(self.get_revision_data(note_id,number))
+
+	@timed
+	def purge_notes(self,note_ids):
+		# removes everything that belongs to notes deleted for good, but the rows
+		for chunk in chunks(note_ids):
+			self.session.query(NoteRevision).filter(NoteRevision.note_id.in_(chunk)).delete(synchronize_session=False)
+		self.remove_from_index(note_ids)
+		self.forget_images(note_ids)
+
+	@timed
+	def forget_images(self,note_ids):
+		# drops the image references of notes that are deleted for good,
+		# images no note refers to any more are removed
+		for chunk in chunks(note_ids):
+			self.session.query(NoteImage).filter(NoteImage.note_id.in_(chunk)).delete(synchronize_session=False)
+		self.collect_images()
+
+	@timed
+	def collect_images(self):
+		# removes the images no note refers to
+		referenced = self.session.query(NoteImage.digest)
+		self.session.query(Image).filter(~Image.digest.in_(referenced)).delete(synchronize_session=False)
+
+	@timed
+	def create_notebook(self,name,idd,special=None):
+		notebook = Notebook(name=name, idd = idd, special=special)
+		self.session.add(notebook)
+		self.session.commit()
+
+	@timed
+	def get_trash_id(self):
+		# the Trash never changes its id, it is looked up once
+		if self.trash_id is None:
+			self.trash_id = self.session.query(Notebook.idd).filter_by(special=migrations.TRASH).scalar()
+		return self.trash_id
+
+	@timed
+	def delete_notebook(self,idd):
+		# the notes go to the Trash, the notes of the Trash are deleted for good
+		trash_id = self.get_trash_id()
+		if idd == trash_id:
+			self.purge_notes(self.get_note_ids(trash_id))
+			self.session.query(Note).filter_by(notebook_id=trash_id).delete(synchronize_session=False)
+		else:
+			note_ids = self.get_note_ids(idd)
+			self.session.query(Note).filter_by(notebook_id=idd).update(self.trash_values(trash_id),synchronize_session=False)
+			self.move_in_index(note_ids,trash_id)
+		self.session.query(Notebook).filter_by(idd=idd).delete(synchronize_session=False)
+		self.session.commit()
+
+	@timed
+	def delete_note(self,idd):
+		self.trash_notes([idd])
+
+	@timed
+	def restore_note(self,idd):
+		# returns (notebook id, notebook name, True if the notebook was created),
+		# None if the note is not in the Trash
+		restored = self.restore_notes([idd])
+		if not restored:
+			return None
+		notebook_id,notebook_name,created,note_ids = restored[0]
+		return notebook_id,notebook_name,created
+
+	@timed
+	def get_note_ids(self,notebook_id):
+		return [idd for idd, in self.session.query(Note.idd).filter_by(notebook_id=notebook_id)]
+
+	def trash_values(self,trash_id):
+		# the SET of an UPDATE that moves notes to the Trash, the right hand
+		# sides see the row as it was before the update
+		notebook_name = select([Notebook.name]).where(Notebook.idd == Note.notebook_id).as_scalar()
+		return {Note.deleted_notebook_name: notebook_name,
+		        Note.deleted_notebook_id: Note.notebook_id,
+		        Note.notebook_id: trash_id}
+
+	@timed
+	def move_notes(self,note_ids,notebook_id):
+		for chunk in chunks(note_ids):
+			self.session.query(Note).filter(Note.idd.in_(chunk)).update({Note.notebook_id: notebook_id},synchronize_session=False)
+		self.move_in_index(note_ids,notebook_id)
+		self.session.commit()
+
+	@timed
+	def trash_notes(self,note_ids):
+		# notes that are in the Trash already are deleted for good, the rest are
+		# moved there. returns the ids of the deleted ones
+		trash_id = self.get_trash_id()
+		purged = []
+		for chunk in chunks(note_ids):
+			purged.extend(idd for idd, in self.session.query(Note.idd).filter(Note.idd.in_(chunk), Note.notebook_id == trash_id))
+		if purged:
+			self.purge_notes(purged)
+			for chunk in chunks(purged):
+				self.session.query(Note).filter(Note.idd.in_(chunk)).delete(synchronize_session=False)
+		purged_set = set(purged)
+		moved = [idd for idd in note_ids if idd not in purged_set]
+		for chunk in chunks(moved):
+			self.session.query(Note).filter(Note.idd.in_(chunk)).update(self.trash_values(trash_id),synchronize_session=False)
+		self.move_in_index(moved,trash_id)
+		self.session.commit()
+		return purged
+
+	@timed
+	def restore_notes(self,note_ids):
+		# puts notes of the Trash back in the notebooks they were deleted from,
+		# notebooks that were deleted meanwhile are created again.
+		# returns (notebook id, notebook name, True if created, note ids) for
+		# every notebook notes went back to
+		trash_id = self.get_trash_id()
+		targets = collections.OrderedDict()
+		for chunk in chunks(note_ids):
+			rows = self.session.query(Note.idd, Note.deleted_notebook_id, Note.deleted_notebook_name) \
+				.filter(Note.idd.in_(chunk), Note.notebook_id == trash_id)
+			for idd, notebook_id, notebook_name in rows:
+				targets.setdefault((notebook_id, notebook_name), []).append(idd)
+		existing = set()
+		for chunk in chunks([notebook_id for notebook_id, notebook_name in targets]):
+			existing.update(idd for idd, in self.session.query(Notebook.idd).filter(Notebook.idd.in_(chunk)))
+		restored = []
+		for (notebook_id, notebook_name), ids in targets.items():
+			created = notebook_id not in existing
+			if created:
+				self.session.add(Notebook(name=notebook_name, idd=notebook_id))
+				existing.add(notebook_id)
+			restored.append((notebook_id, notebook_name, created, ids))
+		self.session.flush()
+		for chunk in chunks(note_ids):
+			self.session.query(Note).filter(Note.idd.in_(chunk), Note.notebook_id == trash_id) \
+				.update({Note.notebook_id: Note.deleted_notebook_id,
+				         Note.deleted_notebook_name: None,
+				         Note.deleted_notebook_id: None},synchronize_session=False)
+		for notebook_id, notebook_name, created, ids in restored:
+			self.move_in_index(ids,notebook_id)
+		self.session.commit()
+		return restored
+
+	@timed
+	def empty_trash(self):
+		# returns the ids of the notes that were deleted
+		trash_id = self.get_trash_id()
+		note_ids = self.get_note_ids(trash_id)
+		self.purge_notes(note_ids)
+		self.session.query(Note).filter_by(notebook_id=trash_id).delete(synchronize_session=False)
+		self.session.commit()
+		return note_ids
+
+	@timed
+	def modify_note(self,name,content,idd):
+		note = self.session.query(Note).filter_by(idd=idd).one()
+		note.name = unicode(name,'iso-8859-1')
+		self.set_content(note,content)
+		self.add_revision(note)
+		self.session.commit()
+
+	@timed
+	def get_notebooks(self):
+		notebooks = self.session.query(Notebook).all()
+		return notebooks
+
+	@timed
+	def get_notes_from_notebook(self,notebook_id):
+		notes = self.session.query(Note).filter_by(notebook_id = notebook_id).all()
+		return notes
+
+	@timed
+	def get_note_listing(self):
+		# (idd, name, notebook_id) of every note in a single projected query,
+		# the content column is left on disk
+		listing = self.session.query(Note.idd, Note.name, Note.notebook_id).order_by(Note.notebook_id, Note.idd).all()
+		return listing
+
+	@timed
+	def get_next_ids(self):
+		# (note id, notebook id) after the highest ones in use
+		note_id = self.session.query(func.max(Note.idd)).scalar() or 0
+		notebook_id = self.session.query(func.max(Notebook.idd)).scalar() or 0
+		return note_id + 1, notebook_id + 1
+
+	@timed
+	def import_notes(self,notes):
+		# adds (notebook name, title, serialized content) notes in one
+		# transaction, notebooks that don't exist are created by name.
+		# returns how many were added
+		note_id, notebook_id = self.get_next_ids()
+		notebooks = dict(self.session.query(Notebook.name, Notebook.idd).filter(Notebook.special == None))
+		# a fresh database has no Trash yet, the GUI creates it by this name
+		trash_name = self.session.query(Notebook.name).filter_by(special=migrations.TRASH).scalar() or migrations.TRASH_NAME
+		count = 0
+		# the notes are new, they have no image references or revisions to
+		# look up. Only the images are looked up, once per chunk
+		for chunk in chunks(notes):
+			new_images = {}
+			split = [self.split_content(content,new_images) for notebook_name, title, content in chunk]
+			self.store_images(new_images)
+			now = datetime.datetime.utcnow()
+			indexed = []
+			for (notebook_name, title, content), (data, digests) in zip(chunk,split):
+				if notebook_name == trash_name:
+					notebook_name = IMPORTED_TRASH_NAME.format(trash_name)
+				if notebook_name not in notebooks:
+					self.session.add(Notebook(name=notebook_name, idd=notebook_id))
+					notebooks[notebook_name] = notebook_id
+					notebook_id += 1
+				note = Note(name=title, idd=note_id, notebook_id=notebooks[notebook_name])
+				# the title comes from the file name, the text keeps its first line
+				body = self.fill_content(note,data,digests,titled=False)
+				self.session.add(note)
+				for digest in set(digests):
+					self.session.add(NoteImage(note_id=note_id,digest=digest))
+				self.session.add(NoteRevision(note_id=note_id,number=1,keyframe=True,created=now,data=revisions.encode(note.content)))
+				indexed.append({'idd': note_id, 'name': title, 'body': body, 'notebook_id': note.notebook_id})
+				note_id += 1
+				count += 1
+			self.session.flush()
+			if self.search_enabled:
+				self.session.execute(INDEX_NOTE,indexed)
+		self.session.commit()
+		return count
+
+	@timed
+	def iter_notes(self,notebook_id,batch=200):
+		# (idd, name, stored content) of every note of the notebook, read a
+		# page at a time. The images are left as references
+		after_id = 0
+		while True:
+			page = self.session.query(Note.idd, Note.name, Note.content).filter(Note.notebook_id == notebook_id, Note.idd > after_id) \
+				.order_by(Note.idd).limit(batch).all()
+			for row in page:
+				yield row
+			if len(page) < batch:
+				return
+			after_id = page[-1][0]
+
+	@timed
+	def get_notebook_counts(self):
+		# {notebook id: number of notes}, counted on the notebook_id index
+		counts = self.session.query(Note.notebook_id, func.count(Note.idd)).group_by(Note.notebook_id).all()
+		return dict(counts)
+
+	@timed
+	def get_note_page(self,notebook_id,after_id=0,limit=200):
+		# (idd, name) of the next `limit` notes of the notebook with an id
+		# greater than after_id. Keyset paging, every page is a range scan of
+		# the notebook_id index however deep it is
+		page = self.session.query(Note.idd, Note.name).filter(Note.notebook_id == notebook_id, Note.idd > after_id) \
+			.order_by(Note.idd).limit(limit).all()
+		return page
+
+	@timed
+	def get_note_summaries(self,note_ids):
+		# {idd: (preview, char_count, word_count)} in one projected query per
+		# chunk, neither the content nor the plain text is read
+		summaries = {}
+		for chunk in chunks(note_ids):
+			rows = self.session.query(Note.idd, Note.preview, Note.char_count, Note.word_count).filter(Note.idd.in_(chunk))
+			for idd, preview, char_count, word_count in rows:
+				summaries[idd] = (preview, char_count, word_count)
+		return summaries
+
+	@timed
+	def get_note_content(self,idd):
+		content = self.session.query(Note.content).filter_by(idd=idd).scalar()
+		if not content:
+			return content
+		return self.join_images(content)
+
+	@timed
+	def get_note_layout(self,idd):
+		# the content of a note with a placeholder in place of every stored
+		# image, the editor loads the images it shows with load_images
+		content = self.session.query(Note.content).filter_by(idd=idd).scalar()
+		if not content:
+			return content
+		data, images = note_format.split_images(content)
+		digests = set(rich_text.reference_digest(image) for image in images if rich_text.is_reference(image))
+		sizes = {}
+		for chunk in chunks(digests):
+			for digest, width, height in self.session.query(Image.digest, Image.width, Image.height).filter(Image.digest.in_(chunk)):
+				sizes[digest] = (width, height)
+		placeholders = []
+		for image in images:
+			if rich_text.is_reference(image):
+				digest = rich_text.reference_digest(image)
+				width, height = sizes.get(digest, (1, 1))
+				image = rich_text.make_placeholder(digest, width, height)
+			placeholders.append(image)
+		return note_format.join_images(data,placeholders)
+
+	@timed
+	def join_images(self,content):
+		# puts the images back in place of their references
+		data, images = note_format.split_images(content)
+		digests = [rich_text.reference_digest(image) for image in images if rich_text.is_reference(image)]
+		if digests:
+			stored = self.load_images(digests)
+			images = [stored[rich_text.reference_digest(image)] if rich_text.is_reference(image) else image for image in images]
+		return note_format.join_images(data,images)
+
+	@timed
+	def get_note(self,idd):
+		result = self.session.query(Note).filter_by(idd=idd).one()
+		return result
@@ -0,0 +1,87 @@
+from sqlalchemy import Column, ForeignKey, Integer, String, Text, Boolean, LargeBinary, DateTime, Index
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, deferred
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy import create_engine
+import sqlite3
+import codec
+
+Base = declarative_base()
+
+class EncodedContent(TypeDecorator):
+
+	# the serialized note as a byte string in python, stored through codec.
+	# the column stays TEXT, sqlite keeps the encoded values as blobs in it
+	impl = Text
+
+	def process_bind_param(self, value, dialect):
+		if value is None:
+			return None
+		return sqlite3.Binary(codec.encode(value))
+
+	def process_result_value(self, value, dialect):
+		if value is None:
+			return None
+		return codec.decode(value)
+
+class Notebook(Base):
+
+	__tablename__ = 'notebook'
+	__table_args__ = (Index('ix_notebook_special', 'special', unique=True),)
+
+	idd = Column(Integer,primary_key = True)
+	name = Column(String(250), nullable=False, index=True)
+	# marks the notebooks the application keeps itself, 'trash' for the Trash
+	special = Column(String(16), nullable=True)
+	notes = relationship('Note',backref='notebook')
+
+class Note(Base) :
+
+	__tablename__ = 'note'
+
+	idd = Column(Integer,primary_key=True)
+	name = Column(String(250), nullable=False)
+	# deferred so that listing queries never pull the rich text blob
+	content = deferred(Column(EncodedContent))
+	# kept from the content on every save, see Database.set_content. NULL
+	# until summarize_contents got to notes saved before they were added
+	plain_text = deferred(Column(Text))
+	preview = Column(String(250))
+	char_count = Column(Integer)
+	word_count = Column(Integer)
+	notebook_id = Column(Integer, ForeignKey("notebook.idd"), index=True)
+	deleted_notebook_name = Column(String,nullable=True)
+	deleted_notebook_id = Column(Integer,nullable=True)
+
+class Image(Base):
+
+	__tablename__ = 'image'
+
+	# sha256 of the uncompressed GdkPixdata
+	digest = Column(String(64), primary_key=True)
+	# zlib compressed GdkPixdata
+	data = Column(LargeBinary, nullable=False)
+	# size of the image, the editor lays a note out before loading its images
+	width = Column(Integer)
+	height = Column(Integer)
+
+class NoteImage(Base):
+
+	__tablename__ = 'note_image'
+
+	note_id = Column(Integer, ForeignKey("note.idd"), primary_key=True)
+	digest = Column(String(64), ForeignKey("image.digest"), primary_key=True, index=True)
+
+class NoteRevision(Base):
+
+	__tablename__ = 'note_revision'
+	__table_args__ = (Index('ix_note_revision_note_number', 'note_id', 'number'),)
+
+	idd = Column(Integer, primary_key=True)
+	note_id = Column(Integer, ForeignKey("note.idd"), nullable=False)
+	# counts up from 1 for every note
+	number = Column(Integer, nullable=False)
+	keyframe = Column(Boolean, nullable=False)
+	created = Column(DateTime, nullable=False)
+	# zlib compressed, the whole content for keyframes and a delta otherwise
+	data = Column(LargeBinary, nullable=False)
@@ -0,0 +1,164 @@
+import collections
+import functools
+import json
+import math
+import os
+import threading
+from timeit import default_timer as timer
+
+#
+# Call counts and latency histograms of every function wrapped by
+# instrumented, or by logger.logging_decorator in the GUI, kept per
+# subsystem. Latencies go into log scale buckets, four per doubling starting
+# at one microsecond, so recording a call is a few arithmetic operations and
+# the percentiles are accurate to about 20%.
+#
+# This module is part of the core so that the storage code is timed without
+# the logging setup of the GUI. NOTED_STATS=0 turns the timing off.
+#
+
+BUCKETS_PER_OCTAVE = 4
+MIN_SECONDS = 1e-6
+
+enabled = os.environ.get('NOTED_STATS', '1') != '0'
+
+stats = {}
+stats_lock = threading.Lock()
+
+
+def bucket_index(elapsed):
+	if elapsed <= MIN_SECONDS:
+		return 0
+	return int(math.log(elapsed / MIN_SECONDS, 2) * BUCKETS_PER_OCTAVE) + 1
+
+
+def bucket_upper(index):
+	return MIN_SECONDS * 2 ** (float(index) / BUCKETS_PER_OCTAVE)
+
+
+class Stat(object):
+
+	# the decorated functions run on the main loop and on the workers, the
+	# lock keeps their updates from getting lost
+	__slots__ = ('subsystem', 'name', 'calls', 'errors', 'total', 'longest', 'buckets', 'lock')
+
+	def __init__(self, subsystem, name):
+		self.subsystem = subsystem
+		self.name = name
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.calls = 0
+			self.errors = 0
+			self.total = 0.0
+			self.longest = 0.0
+			self.buckets = {}
+
+	def record(self, elapsed):
+		index = bucket_index(elapsed)
+		with self.lock:
+			self.calls += 1
+			self.total += elapsed
+			if elapsed > self.longest:
+				self.longest = elapsed
+			self.buckets[index] = self.buckets.get(index, 0) + 1
+
+	def record_error(self):
+		with self.lock:
+			self.errors += 1
+
+	def percentile(self, fraction):
+		wanted = fraction * self.calls
+		seen = 0
+		for index in sorted(self.buckets):
+			seen += self.buckets[index]
+			if seen >= wanted:
+				return min(bucket_upper(index), self.longest)
+		return self.longest
+
+	def as_dict(self):
+		with self.lock:
+			return self.values()
+
+	def values(self):
+		return {'subsystem': self.subsystem,
+				'function': self.name,
+				'calls': self.calls,
+				'errors': self.errors,
+				'total_ms': self.total * 1000,
+				'mean_ms': self.total * 1000 / self.calls if self.calls else 0.0,
+				'p50_ms': self.percentile(0.50) * 1000,
+				'p95_ms': self.percentile(0.95) * 1000,
+				'p99_ms': self.percentile(0.99) * 1000,
+				'max_ms': self.longest * 1000,
+				'histogram': dict(('{:.4g}'.format(bucket_upper(index) * 1000), count) for index, count in self.buckets.items())}
+
+
+def get_stat(subsystem, name):
+	# called once per decorated function, when the module is imported
+	with stats_lock:
+		key = (subsystem, name)
+		if key not in stats:
+			stats[key] = Stat(subsystem, name)
+		return stats[key]
+
+
+def instrumented(subsystem, log):
+	# times the calls of a core function, log is the logging.Logger of its
+	# module and gets the failures
+	def decorator(function):
+		stat = get_stat(subsystem, function.__name__)
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if enabled:
+				start = timer()
+			try:
+				return function(*args, **kwargs)
+			except Exception as e:
+				stat.record_error()
+				log.error('There was a problem running the function %s ; ERROR MESSAGE > %s', function.__name__, e)
+				raise
+			finally:
+				if enabled:
+					stat.record(timer() - start)
+		return wrapper
+	return decorator
+
+
+def snapshot():
+	# the stats of the functions that were called, slowest subsystem total
+	# first and the slowest function first within a subsystem
+	called = [stat.as_dict() for stat in stats.values() if stat.calls]
+	totals = collections.defaultdict(float)
+	for item in called:
+		totals[item['subsystem']] += item['total_ms']
+	called.sort(key=lambda item: (-totals[item['subsystem']], item['subsystem'], -item['total_ms']))
+	return called
+
+
+def report():
+	lines = ['{:<12} {:<28} {:>8} {:>11} {:>9} {:>9} {:>9} {:>9}'.format(
+		'Subsystem', 'Function', 'Calls', 'Total ms', 'p50 ms', 'p95 ms', 'p99 ms', 'Max ms')]
+	for item in snapshot():
+		lines.append('{:<12} {:<28} {:>8} {:>11.2f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+			item['subsystem'], item['function'], item['calls'], item['total_ms'],
+			item['p50_ms'], item['p95_ms'], item['p99_ms'], item['max_ms']))
+	return '\n'.join(lines)
+
+
+def dump(directory):
+	# writes stats.txt and stats.json to directory and returns their paths
+	text_path = '{}/stats.txt'.format(directory)
+	json_path = '{}/stats.json'.format(directory)
+	with open(text_path, 'w') as text_file:
+		text_file.write(report() + '\n')
+	with open(json_path, 'w') as json_file:
+		json.dump(snapshot(), json_file, indent=1, sort_keys=True)
+	return text_path, json_path
+
+
+def reset():
+	for stat in stats.values():
+		stat.reset()
@@ -0,0 +1,108 @@
+#
+# Conversion between Markdown or plain text and stored notes.
+#
+# Only what the editor can show is kept: '# ' lines become the title tag,
+# '## ' and deeper headings the header tag, **bold**, *italic* and
+# <u>underline</u> their tags. Everything else stays as it is written.
+# Images are not converted in either direction.
+#
+import re
+import note_format
+
+TAGS = ('bold', 'italic', 'underline', 'title', 'header')
+
+HEADING_PATTERN = re.compile(r'^(#{1,6})\s+(.*)$')
+# single underscores are left alone, they are more often in names than italic
+INLINE_PATTERN = re.compile(r'(\*\*|__)(.+?)\1|\*(.+?)\*|<u>(.+?)</u>')
+
+
+def inline(text, parts, spans, length):
+    # adds the text of a line to parts and its tags to spans, returns the
+    # length of the note after it
+    position = 0
+    for match in INLINE_PATTERN.finditer(text):
+        parts.append(text[position:match.start()])
+        length += match.start() - position
+        if match.group(2) is not None:
+            tag, inner = 'bold', match.group(2)
+        elif match.group(3) is not None:
+            tag, inner = 'italic', match.group(3)
+        else:
+            tag, inner = 'underline', match.group(4)
+        parts.append(inner)
+        spans.append((tag, length, length + len(inner)))
+        length += len(inner)
+        position = match.end()
+    parts.append(text[position:])
+    return length + len(text) - position
+
+
+def to_note(text, markdown=True):
+    # unicode text to the stored content of a note. An image character in
+    # the text would need an image record
+    text = text.replace(note_format.IMAGE, u'')
+    parts = []
+    spans = []
+    length = 0
+    for line in text.splitlines():
+        heading = HEADING_PATTERN.match(line) if markdown else None
+        if heading is not None:
+            tag = 'title' if len(heading.group(1)) == 1 else 'header'
+            parts.append(heading.group(2))
+            spans.append((tag, length, length + len(heading.group(2))))
+            length += len(heading.group(2))
+        elif markdown:
+            length = inline(line, parts, spans, length)
+        else:
+            parts.append(line)
+            length += len(line)
+        parts.append(u'\n')
+        length += 1
+    return note_format.dumps(note_format.Note(u''.join(parts), [span for span in spans if span[2] > span[1]]))
+
+
+def segments(note):
+    # (tags, text) of the runs of the note with the same tags
+    boundaries = set([0, len(note.text)])
+    for name, start, end in note.spans:
+        if name in TAGS:
+            boundaries.add(start)
+            boundaries.add(end)
+    boundaries = sorted(boundaries)
+    spans = sorted((span for span in note.spans if span[0] in TAGS), key=lambda span: span[1])
+    index = 0
+    active = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        while index < len(spans) and spans[index][1] <= start:
+            active.append(spans[index])
+            index += 1
+        active = [span for span in active if span[2] > start]
+        yield set(name for name, span_start, span_end in active), note.text[start:end]
+
+
+def to_markdown(data):
+    # stored content to unicode Markdown
+    parts = []
+    line_start = True
+    for active, text in segments(note_format.loads(data)):
+        text = text.replace(note_format.IMAGE, u'')
+        for number, piece in enumerate(text.split(u'\n')):
+            if number:
+                parts.append(u'\n')
+                line_start = True
+            if not piece:
+                continue
+            if line_start:
+                if 'title' in active:
+                    parts.append(u'# ')
+                elif 'header' in active:
+                    parts.append(u'## ')
+            if 'underline' in active:
+                piece = u'<u>{}</u>'.format(piece)
+            if 'italic' in active:
+                piece = u'*{}*'.format(piece)
+            if 'bold' in active:
+                piece = u'**{}**'.format(piece)
+            parts.append(piece)
+            line_start = False
+    return u''.join(parts)
@@ -0,0 +1,88 @@
+#
+# Schema migrations of the SQLite store.
+#
+# The schema version is kept in PRAGMA user_version. Every function in
+# MIGRATIONS upgrades the database by one version and runs in its own
+# transaction together with the version bump, so an interrupted upgrade is
+# picked up again on the next start. create_all makes new databases with the
+# current tables already, the migrations check before they change anything
+# so that they can run on those as well.
+#
+import logging
+import zlib
+from sqlalchemy import text
+import instrumentation
+import rich_text
+
+logger = logging.getLogger(__name__)
+
+# notebook.special of the Trash notebook and the name it is created with
+TRASH = 'trash'
+TRASH_NAME = 'Trash'
+
+
+def columns(connection, table):
+    return [row[1] for row in connection.execute(text("PRAGMA table_info({})".format(table)))]
+
+
+def add_indexes_and_trash(connection):
+    # the notes of a notebook and the Trash are looked up on every delete
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_note_notebook_id ON note (notebook_id)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_notebook_name ON notebook (name)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_note_image_digest ON note_image (digest)"))
+    if 'special' not in columns(connection, 'notebook'):
+        connection.execute(text("ALTER TABLE notebook ADD COLUMN special VARCHAR(16)"))
+    connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_notebook_special ON notebook (special)"))
+    # the Trash was only known by its name until now
+    trash = connection.execute(text("SELECT idd FROM notebook WHERE name = 'Trash' ORDER BY idd")).first()
+    if trash is not None and connection.execute(text("SELECT COUNT(*) FROM notebook WHERE special = :special"),
+                                                 special=TRASH).scalar() == 0:
+        connection.execute(text("UPDATE notebook SET special = :special WHERE idd = :idd"),
+                           special=TRASH, idd=trash[0])
+
+
+def add_image_sizes(connection):
+    # only the header of every image is decompressed for its size
+    if 'width' not in columns(connection, 'image'):
+        connection.execute(text("ALTER TABLE image ADD COLUMN width INTEGER"))
+        connection.execute(text("ALTER TABLE image ADD COLUMN height INTEGER"))
+    rows = connection.execute(text("SELECT digest, data FROM image WHERE width IS NULL")).fetchall()
+    for digest, data in rows:
+        header = zlib.decompressobj().decompress(data, rich_text.PIXDATA_HEADER_LENGTH)
+        width, height = rich_text.pixdata_size(header)
+        connection.execute(text("UPDATE image SET width = :width, height = :height WHERE digest = :digest"),
+                           width=width, height=height, digest=digest)
+
+
+def add_note_summaries(connection):
+    # the values are filled in by Database.summarize_contents in the
+    # background, decoding every note here would hold up the start
+    existing = columns(connection, 'note')
+    for name, column_type in (('plain_text', 'TEXT'), ('preview', 'VARCHAR(250)'),
+                              ('char_count', 'INTEGER'), ('word_count', 'INTEGER')):
+        if name not in existing:
+            connection.execute(text("ALTER TABLE note ADD COLUMN {} {}".format(name, column_type)))
+
+
+MIGRATIONS = [add_indexes_and_trash, add_image_sizes, add_note_summaries]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version(connection):
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+@instrumentation.instrumented('Migrations', logger)
+def migrate(engine):
+    # brings the database up to SCHEMA_VERSION, returns the version it had
+    with engine.connect() as connection:
+        version = get_version(connection)
+    if version > SCHEMA_VERSION:
+        logger.warning('database schema {} is newer than {}'.format(version, SCHEMA_VERSION))
+        return version
+    for number in range(version, SCHEMA_VERSION):
+        logger.info('migrating database schema to {}'.format(number + 1))
+        with engine.begin() as connection:
+            MIGRATIONS[number](connection)
+            connection.execute(text("PRAGMA user_version = {}".format(number + 1)))
+    return version
@@ -0,0 +1,262 @@
+#
+# The format notes are stored in.
+#
+#   MAGIC | version (1 byte) | offset of the images (uint32 BE)
+#   text: utf-8 length, utf-8 text
+#   tags: count, then every tag name as its length and utf-8 name
+#   spans: count, then tag index, start, length for every span
+#   images: count, then every image record as its length and the record
+#
+# All the numbers after the header are unsigned LEB128 varints. The spans
+# are ordered by start and every start is counted from the one before, so
+# runs of formatting take a few bytes each. Offsets are in characters. Every
+# U+FFFC of the text is an image, the records are in the same order and are
+# the GdkPixdata, reference or placeholder records of rich_text.
+#
+# The images come last so that Database.set_content can swap them without
+# touching the rest. Notes saved before this format are GTK tagsets, loads
+# reads those as well and Database.convert_contents rewrites them.
+#
+import bisect
+import re
+import struct
+import rich_text
+
+MAGIC = 'NOTEDRT'
+VERSION = 1
+HEADER_LENGTH = len(MAGIC) + 1 + 4
+IMAGE = u'\ufffc'
+# the title of a note is its first line, up to TITLE_LENGTH characters
+TITLE_LENGTH = 20
+PREVIEW_LENGTH = 120
+
+APPLY_TAG_PATTERN = re.compile(r'<apply_tag name="([^"]*)">')
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+SPACE_PATTERN = re.compile(r'\s+', re.UNICODE)
+
+
+class Note(object):
+    # text is unicode, spans are (tag name, start, end) ordered by start and
+    # images are the records of the U+FFFC characters of the text
+
+    def __init__(self, text=u'', spans=None, images=None):
+        self.text = text
+        self.spans = spans if spans is not None else []
+        self.images = images if images is not None else []
+
+
+def is_note(data):
+    return data is not None and data.startswith(MAGIC)
+
+
+def write_varint(parts, value):
+    while value > 0x7f:
+        parts.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    parts.append(chr(value))
+
+
+def read_varint(data, position):
+    # returns the value and the position after it
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[position])
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def write_bytes(parts, value):
+    write_varint(parts, len(value))
+    parts.append(value)
+
+
+def read_bytes(data, position):
+    length, position = read_varint(data, position)
+    return data[position:position + length], position + length
+
+
+def dumps(note):
+    parts = []
+    write_bytes(parts, note.text.encode('utf-8'))
+    names = sorted(set(name for name, start, end in note.spans))
+    indexes = dict((name, index) for index, name in enumerate(names))
+    write_varint(parts, len(names))
+    for name in names:
+        write_bytes(parts, name.encode('utf-8'))
+    spans = sorted(note.spans, key=lambda span: (span[1], span[0]))
+    write_varint(parts, len(spans))
+    previous = 0
+    for name, start, end in spans:
+        write_varint(parts, indexes[name])
+        write_varint(parts, start - previous)
+        write_varint(parts, end - start)
+        previous = start
+    body = ''.join(parts)
+    data = MAGIC + chr(VERSION) + struct.pack('>I', HEADER_LENGTH + len(body)) + body
+    return join_images(data, note.images)
+
+
+def read_text(data):
+    # the text and the position after it
+    text, position = read_bytes(data, HEADER_LENGTH)
+    return text.decode('utf-8'), position
+
+
+def loads(data):
+    # a Note from stored content in this format, a tagset or plain text
+    if not data:
+        return Note()
+    if not is_note(data):
+        return from_tagset(data)
+    if ord(data[len(MAGIC)]) > VERSION:
+        raise ValueError('note format {} is newer than {}'.format(ord(data[len(MAGIC)]), VERSION))
+    text, position = read_text(data)
+    count, position = read_varint(data, position)
+    names = []
+    for _ in xrange(count):
+        name, position = read_bytes(data, position)
+        names.append(name.decode('utf-8'))
+    count, position = read_varint(data, position)
+    spans = []
+    start = 0
+    for _ in xrange(count):
+        index, position = read_varint(data, position)
+        delta, position = read_varint(data, position)
+        length, position = read_varint(data, position)
+        start += delta
+        spans.append((names[index], start, start + length))
+    return Note(text, spans, split_images(data)[1])
+
+
+def split_images(data):
+    # the content without its images and the image records, for both formats
+    if not is_note(data):
+        return rich_text.split_images(data)
+    offset = struct.unpack('>I', data[len(MAGIC) + 1:HEADER_LENGTH])[0]
+    images = []
+    if offset < len(data):
+        count, position = read_varint(data, offset)
+        for _ in xrange(count):
+            image, position = read_bytes(data, position)
+            images.append(image)
+    return data[:offset], images
+
+
+def join_images(data, images):
+    if not is_note(data):
+        return rich_text.join_images(data, images)
+    parts = [data]
+    write_varint(parts, len(images))
+    for image in images:
+        write_bytes(parts, image)
+    return ''.join(parts)
+
+
+def plain_text(data):
+    # the text of stored content as unicode, without images. Only the text
+    # part is read
+    if not data:
+        return u''
+    if not is_note(data):
+        return rich_text.plain_text(data)
+    return read_text(data)[0].replace(IMAGE, u'')
+
+
+def get_title(text):
+    # the title of a note with plain text `text`, empty for an empty note
+    text = text.lstrip()
+    title_index = text.find(u'\n')
+    if title_index < TITLE_LENGTH and title_index != -1:
+        return text[:title_index]
+    return text[:TITLE_LENGTH]
+
+
+def summarize(text, titled=True):
+    # (preview, characters, words) of a note with plain text `text`. The
+    # preview is the text on one line, after the title when the title of the
+    # note is taken from its text
+    rest = text.lstrip()[len(get_title(text)):] if titled else text
+    preview = SPACE_PATTERN.sub(u' ', rest[:PREVIEW_LENGTH * 4]).strip()[:PREVIEW_LENGTH]
+    return preview, len(text), len(WORD_PATTERN.findall(text))
+
+
+def from_tagset(data):
+    # a Note from a serialized GTK tagset, images keep their records
+    if not data.startswith(rich_text.HEADER):
+        return Note(data.decode('utf-8', 'replace'))
+    before, markup, after, images = rich_text.parse_document(data)
+    parts = []
+    spans = []
+    note_images = []
+    # tags that are open, with where they start
+    open_tags = []
+    length = 0
+    for match in rich_text.TOKEN_PATTERN.finditer(markup):
+        token = match.group(0)
+        if token.startswith('<apply_tag'):
+            name = APPLY_TAG_PATTERN.match(token)
+            open_tags.append((name.group(1) if name is not None else None, length))
+        elif token == '</apply_tag>':
+            name, start = open_tags.pop()
+            if name is not None and length > start:
+                spans.append((name.decode('utf-8'), start, length))
+        elif token.startswith('<pixbuf'):
+            note_images.append(images[int(rich_text.PIXBUF_PATTERN.match(token).group(1))])
+            parts.append(IMAGE)
+            length += 1
+        elif not token.startswith('<'):
+            text = token.decode('utf-8', 'replace')
+            if token.startswith('&'):
+                text = rich_text.ENTITY_PATTERN.sub(rich_text.unescape, text)
+            parts.append(text)
+            length += len(text)
+    spans.sort(key=lambda span: (span[1], span[0]))
+    return Note(u''.join(parts), spans, note_images)
+
+
+def image_offsets(note):
+    offsets = []
+    offset = note.text.find(IMAGE)
+    while offset != -1:
+        offsets.append(offset)
+        offset = note.text.find(IMAGE, offset + 1)
+    return offsets
+
+
+def split_note(note, size):
+    # cuts a note into notes of about size characters that join back to it
+    offsets = image_offsets(note)
+    spans = sorted(note.spans, key=lambda span: span[1])
+    index = 0
+    # the spans that reach into the piece
+    active = []
+    pieces = []
+    for start in xrange(0, max(len(note.text), 1), size):
+        end = start + size
+        while index < len(spans) and spans[index][1] < end:
+            active.append(spans[index])
+            index += 1
+        active = [span for span in active if span[2] > start]
+        piece_spans = [(name, max(span_start, start) - start, min(span_end, end) - start)
+                       for name, span_start, span_end in active]
+        images = note.images[bisect.bisect_left(offsets, start):bisect.bisect_left(offsets, end)]
+        pieces.append(Note(note.text[start:end], piece_spans, images))
+    return pieces
+
+
+def join_notes(notes):
+    text = []
+    spans = []
+    images = []
+    length = 0
+    for note in notes:
+        text.append(note.text)
+        spans.extend((name, start + length, end + length) for name, start, end in note.spans)
+        images.extend(note.images)
+        length += len(note.text)
+    spans.sort(key=lambda span: (span[1], span[0]))
+    return Note(u''.join(text), spans, images)
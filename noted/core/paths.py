@@ -0,0 +1,24 @@
+import os
+
+#
+# Where Noted keeps its files, the same directories GLib.get_user_data_dir
+# gives without having to load GLib.
+#
+
+
+def user_data_dir():
+    path = os.environ.get('XDG_DATA_HOME')
+    if not path:
+        path = os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return path
+
+
+def data_dir(create=False):
+    path = os.path.join(user_data_dir(), 'Noted')
+    if create and not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def database_path():
+    return os.path.join(data_dir(), 'sqlitedatabase.db')
@@ -0,0 +1,116 @@
+#
+# Deltas between revisions of a note.
+#
+# Saves usually change one region of a note, so a delta is the length of the
+# common prefix, the length of the common suffix and the bytes in between.
+# Revisions are stored zlib compressed, every KEYFRAME_INTERVAL revisions (or
+# when a delta would not be much smaller) the whole content is stored so that
+# rebuilding any revision applies at most KEYFRAME_INTERVAL - 1 deltas.
+#
+# The stored formats have lengths near the start that change with every edit
+# of the text, one region over the whole content would run from there to the
+# edit. The content is cut into its sections first, see sections, and every
+# section gets a prefix, a suffix and the bytes in between. An edit of the
+# text changes the lengths, the text and the start of the first span after
+# it, a few bytes more than the edit itself.
+#
+#   DELTA_MAGIC | count | count times: prefix, suffix, length (uint32 BE), bytes
+#
+# Deltas saved before the sections are a prefix and a suffix (uint32 BE) and
+# the bytes in between, DELTA_MAGIC read as a prefix would be over 1 GB.
+#
+import struct
+import zlib
+import rich_text
+import note_format
+
+DELTA_MAGIC = 'NDLT'
+KEYFRAME_INTERVAL = 16
+# revisions kept per note, older ones are pruned PRUNE_BATCH at a time
+MAX_REVISIONS = 100
+PRUNE_BATCH = 20
+# saves this close to the previous one replace it instead of adding a revision
+COALESCE_SECONDS = 60
+
+
+def common_prefix(old, new, limit):
+    # compares slices, big ones first, instead of byte by byte
+    prefix = 0
+    step = 65536
+    while step:
+        while prefix + step <= limit and old[prefix:prefix + step] == new[prefix:prefix + step]:
+            prefix += step
+        step //= 16
+    return prefix
+
+
+def common_suffix(old, new, limit):
+    suffix = 0
+    step = 65536
+    while step:
+        while suffix + step <= limit and \
+                old[len(old) - suffix - step:len(old) - suffix] == new[len(new) - suffix - step:len(new) - suffix]:
+            suffix += step
+        step //= 16
+    return suffix
+
+
+def sections(data):
+    # the content cut where its parts start, the sections join back to it.
+    # A note is its header with the length of the text, the text, the tags
+    # and spans and the images, a tagset its header and the rest
+    if note_format.is_note(data):
+        length, text_start = note_format.read_varint(data, note_format.HEADER_LENGTH)
+        images_start = struct.unpack('>I', data[len(note_format.MAGIC) + 1:note_format.HEADER_LENGTH])[0]
+        return [data[:text_start], data[text_start:text_start + length],
+                data[text_start + length:images_start], data[images_start:]]
+    if data.startswith(rich_text.HEADER):
+        return [data[:len(rich_text.HEADER) + 4], data[len(rich_text.HEADER) + 4:]]
+    return [data]
+
+
+def make_delta(old, new):
+    old_sections = sections(old)
+    new_sections = sections(new)
+    if len(old_sections) != len(new_sections):
+        # one format to another, the whole content is one section
+        old_sections = [old]
+        new_sections = [new]
+    parts = [DELTA_MAGIC, struct.pack('>I', len(new_sections))]
+    for old_section, new_section in zip(old_sections, new_sections):
+        limit = min(len(old_section), len(new_section))
+        prefix = common_prefix(old_section, new_section, limit)
+        suffix = common_suffix(old_section, new_section, limit - prefix)
+        middle = new_section[prefix:len(new_section) - suffix]
+        parts.append(struct.pack('>III', prefix, suffix, len(middle)))
+        parts.append(middle)
+    return ''.join(parts)
+
+
+def apply_delta(old, delta):
+    if not delta.startswith(DELTA_MAGIC):
+        prefix, suffix = struct.unpack('>II', delta[:8])
+        return old[:prefix] + delta[8:] + old[len(old) - suffix:]
+    position = len(DELTA_MAGIC)
+    count = struct.unpack('>I', delta[position:position + 4])[0]
+    position += 4
+    old_sections = sections(old)
+    if len(old_sections) != count:
+        old_sections = [old]
+    parts = []
+    for old_section in old_sections:
+        prefix, suffix, length = struct.unpack('>III', delta[position:position + 12])
+        position += 12
+        parts.append(old_section[:prefix])
+        parts.append(delta[position:position + length])
+        parts.append(old_section[len(old_section) - suffix:])
+        position += length
+    return ''.join(parts)
+
+
+def encode(data):
+    return zlib.compress(data)
+
+
+def decode(data):
+    return zlib.decompress(data)
@@ -0,0 +1,169 @@
+#
+# Helpers for the rich text that Gtk.TextBuffer.serialize writes with the
+# tagset format, the format notes were stored in before note_format, and
+# for the image records both formats use. They work on the raw bytes, no
+# GTK is needed.
+#
+#   "GTKTEXTBUFFERCONTENTS-0001" | markup length (uint32 BE) | markup | images
+#
+# Every image is a serialized GdkPixdata, its second uint32 is the length of
+# the whole record. The database swaps the pixdata for a reference record
+# pointing into the image table, see Database.set_content.
+#
+# The editor loads stored images lazily. A note is handed to it with a
+# placeholder in place of every reference, a tiny GdkPixdata whose pixels
+# hold the digest and the size of the image, and it saves the images it has
+# not loaded as references again, see restore_reference.
+#
+import re
+import struct
+import binascii
+import hashlib
+
+HEADER = 'GTKTEXTBUFFERCONTENTS-0001'
+PIXDATA_MAGIC = 'GdkP'
+PIXDATA_HEADER_LENGTH = 24
+# raw 8 bit RGBA, the only kind gtk_text_buffer_serialize writes
+PIXDATA_RGBA = 0x01010002
+IMAGE_REFERENCE = 'NOTEDIMG'
+DIGEST_LENGTH = 64
+# pixels of a placeholder, IMAGE_REFERENCE, the binary digest, width, height
+PLACEHOLDER_LENGTH = len(IMAGE_REFERENCE) + DIGEST_LENGTH // 2 + 8
+PLACEHOLDER_WIDTH = PLACEHOLDER_LENGTH // 4
+
+TEXT_PATTERN = re.compile(r'<text>(.*)</text>', re.DOTALL)
+ELEMENT_PATTERN = re.compile(r'<[^>]*>')
+ENTITY_PATTERN = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|amp|lt|gt|quot|apos);')
+# a tag, an entity or a run of plain text in the markup of the text
+TOKEN_PATTERN = re.compile(r'<[^>]*>|&[^;]*;|[^<&]+')
+PIXBUF_PATTERN = re.compile(r'<pixbuf index="([0-9]+)" />')
+ENTITIES = {'amp': u'&', 'lt': u'<', 'gt': u'>', 'quot': u'"', 'apos': u"'"}
+
+
+def markup_end(data):
+    # offset of the first byte after the markup
+    start = len(HEADER) + 4
+    length = struct.unpack('>I', data[len(HEADER):start])[0]
+    return start + length
+
+
+def build(markup, images=()):
+    # the inverse of splitting, markup is the utf-8 text_view_markup document
+    return HEADER + struct.pack('>I', len(markup)) + markup + ''.join(images)
+
+
+def make_pixdata(width, height, pixels):
+    # pixels are width * height RGBA bytes without row padding
+    rowstride = width * 4
+    return PIXDATA_MAGIC + struct.pack('>IIIII', PIXDATA_HEADER_LENGTH + len(pixels), PIXDATA_RGBA,
+                                       rowstride, width, height) + pixels
+
+
+def pixdata_size(image):
+    # (width, height) from the header of a GdkPixdata
+    return struct.unpack('>II', image[16:PIXDATA_HEADER_LENGTH])
+
+
+def pixdata_pixels(image):
+    # (width, height, rowstride, pixels) of a GdkPixdata
+    rowstride, width, height = struct.unpack('>III', image[12:PIXDATA_HEADER_LENGTH])
+    return width, height, rowstride, image[PIXDATA_HEADER_LENGTH:]
+
+
+def make_placeholder(digest, width, height):
+    pixels = IMAGE_REFERENCE + binascii.unhexlify(digest) + struct.pack('>II', width, height)
+    return make_pixdata(PLACEHOLDER_WIDTH, 1, pixels)
+
+
+def read_placeholder(pixels):
+    # (digest, width, height) from the pixels of a placeholder, None if they
+    # are the pixels of an image
+    if len(pixels) < PLACEHOLDER_LENGTH or not pixels.startswith(IMAGE_REFERENCE):
+        return None
+    start = len(IMAGE_REFERENCE)
+    end = start + DIGEST_LENGTH // 2
+    width, height = struct.unpack('>II', pixels[end:PLACEHOLDER_LENGTH])
+    return binascii.hexlify(pixels[start:end]), width, height
+
+
+def parse_document(data):
+    # (markup before the text, the text, markup after it, images)
+    markup = data[len(HEADER) + 4:markup_end(data)]
+    match = TEXT_PATTERN.search(markup)
+    return markup[:match.start(1)], match.group(1), markup[match.end(1):], split_images(data)[1]
+
+
+def restore_reference(image):
+    # the reference of a placeholder, any other record as it is
+    if not is_reference(image) and pixdata_size(image) == (PLACEHOLDER_WIDTH, 1):
+        placeholder = read_placeholder(pixdata_pixels(image)[3])
+        if placeholder is not None:
+            return make_reference(placeholder[0])
+    return image
+
+
+def escape(text):
+    # unicode text to utf-8 that can be put in the markup
+    text = text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+    return text.replace(u'"', u'&quot;').replace(u"'", u'&apos;').encode('utf-8')
+
+
+def split_images(data):
+    # returns the serialized text without its images and the images in
+    # pixbuf index order. An image is either a GdkPixdata or a reference
+    if not data.startswith(HEADER):
+        return data, []
+    end = markup_end(data)
+    images = []
+    position = end
+    while position < len(data):
+        if data.startswith(IMAGE_REFERENCE, position):
+            length = len(IMAGE_REFERENCE) + DIGEST_LENGTH
+        elif data.startswith(PIXDATA_MAGIC, position):
+            length = struct.unpack('>I', data[position + 4:position + 8])[0]
+        else:
+            raise ValueError('Unknown image record at offset {}'.format(position))
+        images.append(data[position:position + length])
+        position += length
+    return data[:end], images
+
+
+def join_images(data, images):
+    return data + ''.join(images)
+
+
+def is_reference(image):
+    return image.startswith(IMAGE_REFERENCE)
+
+
+def make_reference(digest):
+    return IMAGE_REFERENCE + digest
+
+
+def reference_digest(image):
+    return image[len(IMAGE_REFERENCE):]
+
+
+def image_digest(image):
+    return hashlib.sha256(image).hexdigest()
+
+
+def unescape(match):
+    entity = match.group(1)
+    if entity.startswith('#x'):
+        return unichr(int(entity[2:], 16))
+    elif entity.startswith('#'):
+        return unichr(int(entity[1:]))
+    return ENTITIES[entity]
+
+
+def plain_text(data):
+    # the text of a serialized note as unicode, without tags and images
+    if not data.startswith(HEADER):
+        return data.decode('utf-8', 'replace')
+    markup = data[len(HEADER) + 4:markup_end(data)]
+    match = TEXT_PATTERN.search(markup)
+    if match is None:
+        return u''
+    text = ELEMENT_PATTERN.sub('', match.group(1)).decode('utf-8', 'replace')
+    return ENTITY_PATTERN.sub(unescape, text)
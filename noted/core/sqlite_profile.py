@@ -0,0 +1,98 @@
+import os
+from sqlalchemy import create_engine, event, pool
+import logging
+import instrumentation
+
+#
+# How the SQLite database is opened.
+#
+# Every connection gets the PRAGMAs of the profile when it is opened. The
+# defaults use WAL with synchronous=NORMAL: a commit appends to the WAL
+# without waiting for fsync, and a crash of the application or of the
+# system can lose at most the last commits but never corrupts the file.
+# Every setting can be changed with an environment variable, e.g.
+# NOTED_SQLITE_SYNCHRONOUS=FULL or NOTED_SQLITE_MMAP_SIZE=0.
+#
+# The connections are pooled so that the page cache survives commits. A
+# connection is only used by one thread at a time, the Database of a worker
+# has a session of its own.
+#
+# maintain() is run every MAINTENANCE_SECONDS and on close, it moves the WAL
+# into the database file and lets SQLite refresh its query planner stats.
+#
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    # bytes of the file that are read through mmap
+    'mmap_size': 64 * 1024 * 1024,
+    # negative is KiB, positive is pages
+    'cache_size': -16 * 1024,
+    'temp_store': 'MEMORY',
+    # ms a connection waits for another one to finish writing
+    'busy_timeout': 5000,
+}
+
+CHOICES = {
+    'journal_mode': ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'),
+    'synchronous': ('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+    'temp_store': ('DEFAULT', 'FILE', 'MEMORY'),
+}
+
+MAINTENANCE_SECONDS = 300
+POOL_SIZE = 2
+
+
+def load_profile(environ=os.environ):
+    # the defaults with the NOTED_SQLITE_* overrides, bad values are ignored
+    profile = dict(DEFAULTS)
+    for name in DEFAULTS:
+        value = environ.get('NOTED_SQLITE_{}'.format(name.upper()))
+        if value is None:
+            continue
+        if name in CHOICES:
+            if value.upper() in CHOICES[name]:
+                profile[name] = value.upper()
+        else:
+            try:
+                profile[name] = int(value)
+            except ValueError:
+                pass
+    return profile
+
+
+def apply_profile(dbapi_connection, profile):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name in ('busy_timeout', 'journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store'):
+            cursor.execute('PRAGMA {} = {}'.format(name, profile[name]))
+    finally:
+        cursor.close()
+
+
+def open_engine(db_path, profile=None):
+    if profile is None:
+        profile = load_profile()
+    engine = create_engine('sqlite:///{}'.format(db_path), echo=False,
+                           poolclass=pool.QueuePool, pool_size=POOL_SIZE,
+                           connect_args={'check_same_thread': False})
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        apply_profile(dbapi_connection, profile)
+
+    engine.storage_profile = profile
+    return engine
+
+
+@instrumentation.instrumented('Database', logger)
+def maintain(engine, final=False):
+    # PASSIVE never waits for readers or writers, on close TRUNCATE also
+    # empties the WAL file
+    with engine.connect() as connection:
+        if engine.storage_profile['journal_mode'] == 'WAL':
+            mode = 'TRUNCATE' if final else 'PASSIVE'
+            connection.execute('PRAGMA wal_checkpoint({})'.format(mode))
+        connection.execute('PRAGMA optimize')
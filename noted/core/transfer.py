@@ -0,0 +1,126 @@
+#
+# Import and export of directory trees of Markdown and text files.
+#
+# Every directory right under the root is a notebook, the files in it and in
+# its subdirectories are its notes. Files right under the root go to a
+# notebook named after the root. The file name without its extension is the
+# title of the note.
+#
+# The files are walked by a generator and handled WINDOW at a time: the
+# conversion of a window runs on a process pool while the window before it
+# is written in one transaction, so memory stays the same however many
+# files there are.
+#
+import codecs
+import itertools
+import multiprocessing
+import os
+import re
+import sys
+import markdown
+
+EXTENSIONS = {'.md': True, '.markdown': True, '.txt': False}
+WINDOW = 500
+CHUNK_SIZE = 16
+# characters that can't be in a file name
+UNSAFE_PATTERN = re.compile(r'[\x00-\x1f/\\:*?"<>|]')
+
+
+def decode_name(name):
+    return name.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+
+
+def walk(root):
+    # yields (notebook name, path) of every file that can be imported
+    root = os.path.abspath(root)
+    root_name = os.path.basename(root)
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        relative = os.path.relpath(directory, root)
+        notebook_name = root_name if relative == os.curdir else relative.split(os.sep)[0]
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                yield decode_name(notebook_name), os.path.join(directory, name)
+
+
+def read_note(item):
+    # runs on the pool, returns (notebook name, title, serialized content)
+    notebook_name, path = item
+    title, extension = os.path.splitext(os.path.basename(path))
+    with codecs.open(path, 'r', 'utf-8', 'replace') as source:
+        text = source.read()
+    return notebook_name, decode_name(title), markdown.to_note(text, EXTENSIONS[extension.lower()])
+
+
+def windows(iterable, size=WINDOW):
+    iterator = iter(iterable)
+    while True:
+        window = list(itertools.islice(iterator, size))
+        if not window:
+            return
+        yield window
+
+
+def pipeline(pool, function, items, size=WINDOW):
+    # maps function over items on the pool, one window ahead of the consumer.
+    # yields the results of a window as a list
+    pending = None
+    for window in windows(items, size):
+        converted = pool.imap(function, window, CHUNK_SIZE)
+        if pending is not None:
+            yield list(pending)
+        pending = converted
+    if pending is not None:
+        yield list(pending)
+
+
+def import_tree(database, pool, root, size=WINDOW):
+    # returns how many notes were imported
+    count = 0
+    for notes in pipeline(pool, read_note, walk(root), size):
+        count += database.import_notes(notes)
+    return count
+
+
+def file_name(title):
+    name = UNSAFE_PATTERN.sub('_', title).strip(' .')
+    return name or 'Untitled'
+
+
+def free_path(directory, name, extension):
+    path = os.path.join(directory, name + extension)
+    number = 2
+    while os.path.exists(path):
+        path = os.path.join(directory, '{} ({}){}'.format(name, number, extension))
+        number += 1
+    return path
+
+
+def render_note(item):
+    # runs on the pool, returns (title, utf-8 Markdown)
+    title, content = item
+    return title, markdown.to_markdown(content or '').encode('utf-8')
+
+
+def export_tree(database, pool, root, include_trash=False, size=WINDOW):
+    # writes every notebook as a directory of .md files, returns how many
+    count = 0
+    trash_id = database.get_trash_id()
+    for notebook in database.get_notebooks():
+        if notebook.idd == trash_id and not include_trash:
+            continue
+        directory = os.path.join(root, file_name(notebook.name).encode('utf-8'))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        notes = ((name, content) for idd, name, content in database.iter_notes(notebook.idd))
+        for rendered in pipeline(pool, render_note, notes, size):
+            for title, text in rendered:
+                with open(free_path(directory, file_name(title).encode('utf-8'), '.md'), 'wb') as target:
+                    target.write(text)
+                count += 1
+    return count
+
+
+def make_pool(processes=None):
+    # made before the database is opened, the workers don't need it
+    return multiprocessing.Pool(processes)
@@ -1,16 +1,44 @@
 import gi
 gi.require_version('Gtk', '3.0')
 # gi.require_version('Granite', '1.0')
-from gi.repository import Gtk, Gdk, Pango, GdkPixbuf
+from gi.repository import Gtk, Gdk, Pango, GObject, GLib
 import format_toolbar as ft
+import buffer_cache as bc
+import undo_manager as um
+import image_loader as il
+import bisect
+import collections
+import functools
 import subprocess
+import zlib
 from logger import logger as lg
+from core import rich_text
+from core import note_format
 
 WHITESPACE = ('\r', '\n', '\t', ' ')
+# bytes of stored images kept decoded, the shown ones are never dropped
+IMAGE_BUDGET = 32 * 1024 * 1024
+# microseconds after which stored images are asked for again, in case the
+# answer was lost
+IMAGE_REQUEST_TIMEOUT = 10 * 1000 * 1000
+# notes larger than this are loaded in chunks of LOAD_CHUNK_CHARS
+LARGE_NOTE_BYTES = 1024 * 1024
+LOAD_CHUNK_CHARS = 128 * 1024
+# pastes and drops larger than this take the bulk path, see insert_bulk
+BULK_INSERT_BYTES = 64 * 1024
+BULK_CHUNK_CHARS = 64 * 1024
 
+#
+# The undo records keep offsets, text and tag names only, no GTK objects,
+# so that undo_manager can write them to the journal of the note.
+#
+
+@um.record
 class UndoableInsert(object):
 
-    logger = lg.Logger()
+    __slots__ = ('offset', 'text', 'len', 'tags', 'mergeable')
+
+    logger = lg.Logger('Editor')
 
     @lg.logging_decorator(logger)
     def __init__(self,text_iter,text,text_len):
@@ -18,21 +46,24 @@ class UndoableInsert(object):
         self.offset = text_iter.get_offset()
         self.text = text
         self.len = text_len
-        self.tags = text_iter.get_tags()
+        self.tags = [tag.props.name for tag in text_iter.get_tags()]
         if self.len > 1:
             self.mergeable = False
         else:
             self.mergeable = True
 
+@um.record
 class UndoableDelete(object):
 
-    logger = lg.Logger()
+    __slots__ = ('text', 'tags', 'start', 'end', 'delete_key_used', 'mergeable')
+
+    logger = lg.Logger('Editor')
 
     @lg.logging_decorator(logger)
     def __init__(self,buf, start_iter,end_iter):
 
         self.text = buf.get_text(start_iter, end_iter,False)
-        self.tags = start_iter.get_tags()
+        self.tags = [tag.props.name for tag in start_iter.get_tags()]
         self.start = start_iter.get_offset()
         self.end = end_iter.get_offset()
         insert_iter = buf.get_iter_at_mark(buf.get_insert())
@@ -45,9 +76,12 @@ class UndoableDelete(object):
         else:
             self.mergeable = True
             
+@um.record
 class UndoableInsertTag(object):
 
-    logger = lg.Logger()
+    __slots__ = ('tag', 'start', 'end', 'mergeable')
+
+    logger = lg.Logger('Editor')
     
     @lg.logging_decorator(logger)
     def __init__(self, tag, start, end):
@@ -56,9 +90,12 @@ class UndoableInsertTag(object):
         self.end = end.get_offset()
         self.mergeable = False
         
+@um.record
 class UndoableDeleteTag(object):
 
-    logger = lg.Logger()
+    __slots__ = ('tag', 'start', 'end', 'mergeable')
+
+    logger = lg.Logger('Editor')
 
     @lg.logging_decorator(logger)
     def __init__(self,tag,start,end):
@@ -67,10 +104,165 @@ class UndoableDeleteTag(object):
         self.end = end.get_offset()
         self.mergeable = False
 
+@um.record
+class UndoableRangeInsert(object):
+    # a bulk insert. Only the range is kept, the text is read from the buffer
+    # when the insert is undone and dropped again when it is redone
+
+    __slots__ = ('start', 'end', 'tags', 'text', 'mergeable')
+
+    def __init__(self, start, end, tags):
+        self.start = start
+        self.end = end
+        self.tags = tags
+        self.text = None
+        self.mergeable = False
+
+
+#
+# Undo and redo of single records. They only touch the buffer and return the
+# offset the cursor should go to, or None if it stays, so a transaction can be
+# replayed without going through the handlers of the editor for every record.
+#
+
+def revert_action(buf, action):
+    if isinstance(action, UndoableRangeInsert):
+        start = buf.get_iter_at_offset(action.start)
+        end = buf.get_iter_at_offset(action.end)
+        action.text = buf.get_text(start, end, True)
+        buf.delete(start, end)
+        return action.start
+    elif isinstance(action, UndoableInsert):
+        start = buf.get_iter_at_offset(action.offset)
+        end = buf.get_iter_at_offset(action.offset + action.len)
+        buf.delete(start, end)
+        return action.offset
+    elif isinstance(action, UndoableInsertTag):
+        buf.remove_tag_by_name(action.tag, buf.get_iter_at_offset(action.start),
+                               buf.get_iter_at_offset(action.end))
+    elif isinstance(action, UndoableDeleteTag):
+        buf.apply_tag_by_name(action.tag, buf.get_iter_at_offset(action.start),
+                              buf.get_iter_at_offset(action.end))
+    else:
+        buf.insert(buf.get_iter_at_offset(action.start), action.text)
+        for tag in action.tags:
+            buf.apply_tag_by_name(tag, buf.get_iter_at_offset(action.start),
+                                  buf.get_iter_at_offset(action.end))
+        return action.start if action.delete_key_used else action.end
+
+
+def apply_action(buf, action):
+    if isinstance(action, UndoableRangeInsert):
+        buf.insert(buf.get_iter_at_offset(action.start), action.text)
+        for tag in action.tags:
+            buf.apply_tag_by_name(tag, buf.get_iter_at_offset(action.start),
+                                  buf.get_iter_at_offset(action.end))
+        action.text = None
+        return action.end
+    elif isinstance(action, UndoableInsert):
+        buf.insert(buf.get_iter_at_offset(action.offset), action.text)
+        for tag in action.tags:
+            buf.apply_tag_by_name(tag, buf.get_iter_at_offset(action.offset),
+                                  buf.get_iter_at_offset(action.offset + action.len))
+        return action.offset + action.len
+    elif isinstance(action, UndoableInsertTag):
+        buf.apply_tag_by_name(action.tag, buf.get_iter_at_offset(action.start),
+                              buf.get_iter_at_offset(action.end))
+    elif isinstance(action, UndoableDeleteTag):
+        buf.remove_tag_by_name(action.tag, buf.get_iter_at_offset(action.start),
+                               buf.get_iter_at_offset(action.end))
+    else:
+        buf.delete(buf.get_iter_at_offset(action.start), buf.get_iter_at_offset(action.end))
+        return action.start
+
+
+def compact_actions(actions):
+    # joins the records of a transaction that continue each other, a paste or
+    # a list continuation then replays as a few buffer changes
+    compacted = [actions[0]]
+    for action in actions[1:]:
+        prev = compacted[-1]
+        if type(action) is not type(prev) or getattr(action, 'tags', None) != getattr(prev, 'tags', None):
+            compacted.append(action)
+        elif isinstance(action, UndoableInsert) and action.offset == prev.offset + prev.len:
+            prev.text += action.text
+            prev.len += action.len
+        elif isinstance(action, UndoableDelete) and action.delete_key_used == prev.delete_key_used \
+                and action.start == prev.start:
+            prev.text += action.text
+            prev.end += action.end - action.start
+        elif isinstance(action, UndoableDelete) and action.delete_key_used == prev.delete_key_used \
+                and action.end == prev.start:
+            prev.text = action.text + prev.text
+            prev.start = action.start
+        else:
+            compacted.append(action)
+    return compacted
+
+
+class PendingImage(object):
+    # an image that is being decoded. The pixbuf shown for it, the
+    # placeholder and then the thumbnail, is right after the mark. It is in
+    # buf.pending_images until the display rendition is in
+
+    def __init__(self, buf, position, note_id):
+        self.buf = buf
+        self.note_id = note_id
+        self.pixbuf = il.placeholder()
+        self.mark = buf.create_mark(None, position, True)
+        buf.insert_pixbuf(position, self.pixbuf)
+        buf.pending_images.append(self)
+
+    def get_iter(self):
+        # None when the pixbuf was deleted from the buffer
+        if self.mark.get_deleted():
+            return None
+        position = self.buf.get_iter_at_mark(self.mark)
+        if position.get_pixbuf() != self.pixbuf:
+            return None
+        return position
+
+    def finish(self):
+        if self in self.buf.pending_images:
+            self.buf.pending_images.remove(self)
+        if not self.mark.get_deleted():
+            self.buf.delete_mark(self.mark)
+
+
+class LazyImage(object):
+    # a stored image, shown by a child anchor. The anchor gets a widget of
+    # the size of the image when its buffer is shown, the pixels are loaded
+    # once the anchor comes near the viewport
+
+    def __init__(self, anchor, digest, width, height):
+        self.anchor = anchor
+        self.digest = digest
+        self.width = width
+        self.height = height
+        self.widget = None
+
+
+class ChunkedLoad(object):
+    # the rest of a large note, inserted at the mark one piece per idle call.
+    # The mark has right gravity so that it stays after what was loaded
+
+    def __init__(self, buf, pieces, size):
+        self.buf = buf
+        self.pieces = pieces
+        self.size = size
+        self.loaded = 0
+        self.mark = buf.create_mark(None, buf.get_end_iter(), False)
+        self.source_id = None
+
 
 class Editor(Gtk.Grid):
 
-    logger = lg.Logger()
+    __gsignals__ = {
+        # emitted with the note id every time the note in the buffer is edited
+        'modified': (GObject.SignalFlags.RUN_FIRST, None, (int,)),
+    }
+
+    logger = lg.Logger('Editor')
 
     @lg.logging_decorator(logger)
     def __init__(self,parent):
@@ -84,6 +276,7 @@ class Editor(Gtk.Grid):
         self.scrolled_window = Gtk.ScrolledWindow()
         self.scrolled_window.set_vexpand(True)
         self.scrolled_window.set_hexpand(True)
+        self.scrolled_window.get_vadjustment().connect('value-changed', self.schedule_images)
         self.parent = parent
 
         self.current_indent_level = 1
@@ -100,9 +293,27 @@ class Editor(Gtk.Grid):
         self.textview.set_left_margin(25)
         self.textview.set_right_margin(25)
         self.textview.modify_font(Pango.FontDescription.from_string("11"))
-        self.textbuffer = self.textview.get_buffer()
-        self.serialized_format = self.textbuffer.register_serialize_tagset()
-        self.deserialized_format = self.textbuffer.register_deserialize_tagset()
+        self.textview.connect('size-allocate', self.schedule_images)
+        self.textview.connect('paste-clipboard', self.paste_clipboard)
+        self.textview.connect('drag-data-received', self.drag_data_received)
+
+        #############################################################
+        # Buffers
+        #############################################################
+
+        # every note gets its own buffer, they share the tag table.
+        # buffers of recently shown notes are kept in the cache
+        self.tag_table = Gtk.TextTagTable()
+        self.buffer_cache = bc.BufferCache(keep=self.is_busy)
+        # is_unsaved(note_id) tells whether a note has edits that are not
+        # saved yet, it is set by the window
+        self.is_unsaved = None
+        self.buffer_handlers = []
+        self.buffer_size = 0
+        self.textbuffer = None
+        self.images_id = None
+        self.chunked_load = None
+        self.activate_buffer(self.new_buffer())
         
         #############################################################
         # Scrolle Window to TextView
@@ -129,9 +340,7 @@ class Editor(Gtk.Grid):
         # SIGNAL CONNECTIONS
         #############################################################
         
-        self.textbuffer.connect_after("insert-text", self.insert_with_tags)
-        self.textbuffer.connect("delete-range",self.delete)
-        self.textbuffer.connect_after("delete-range",self.delete_after)
+        # the buffer signals are connected in activate_buffer
         
         #############################################################
         #Shortcuts
@@ -153,7 +362,7 @@ class Editor(Gtk.Grid):
         self.format_toolbar.just_fill.connect('clicked', self.apply_just, 'just_fill')
         self.format_toolbar.title.connect('clicked', self.apply_tag, 'title')
         self.format_toolbar.header.connect('clicked', self.apply_tag, 'header')
-        #self.format_toolabar.image.connect("clicked", self.add_image)
+        self.format_toolbar.image.connect("clicked", self.add_image)
         self.format_toolbar.list.connect("clicked",self.add_list)
         self.format_toolbar.undo.connect('clicked',self.undo)
         self.format_toolbar.redo.connect('clicked',self.redo)
@@ -173,28 +382,311 @@ class Editor(Gtk.Grid):
         #UNDO
         #############################################################
         
-        self.undo_stack = []
+        # the undo history of the shown note, see undo_manager
+        self.undo_stack = um.UndoHistory()
         self.redo_stack = []
         self.not_undoable_action = False
         self.undo_in_progress = False
 
+        #############################################################
+        #IMAGES
+        #############################################################
+
+        self.image_loader = il.ImageLoader()
+        # get_images(digests, callback) loads stored images, set by the window
+        self.get_images = None
+        # decoded stored images by digest, least recently shown first
+        self.pixbufs = collections.OrderedDict()
+        self.pixbufs_size = 0
+        self.shown_digests = set()
+        # digests asked for and not answered yet, with the time they were asked
+        self.requested = {}
+
+        #############################################################
+        #DIRTY STATE
+        #############################################################
+
+        # id of the note in the buffer, None when no note is shown
+        self.note_id = None
+        self.loading = False
+
         #############################################################
         #Packing
         #############################################################
         
+        # shown while the tail of a large note is loading
+        self.load_progress = Gtk.ProgressBar()
+        self.load_progress.set_no_show_all(True)
+
         self.attach(self.scrolled_window, 0, 0, 2, 1)
-        self.attach(self.format_toolbar, 0, 1, 2, 1)
+        self.attach(self.load_progress, 0, 1, 2, 1)
+        self.attach(self.format_toolbar, 0, 2, 2, 1)
+
+    @lg.logging_decorator(logger)
+    def new_buffer(self):
+        buf = Gtk.TextBuffer.new(self.tag_table)
+        # the LazyImages and PendingImages of the buffer
+        buf.lazy_images = []
+        buf.pending_images = []
+        return buf
+
+    @lg.logging_decorator(logger)
+    def activate_buffer(self, buf):
+        # shows buf in the text view, only the shown buffer has the handlers
+        # connected so that loading other buffers doesn't run them
+        for handler in self.buffer_handlers:
+            self.textbuffer.disconnect(handler)
+        if self.textbuffer is not None:
+            self.detach_images()
+        self.textbuffer = buf
+        self.buffer_handlers = [buf.connect_after("insert-text", self.insert_with_tags),
+                                buf.connect("delete-range",self.delete),
+                                buf.connect_after("delete-range",self.delete_after),
+                                buf.connect("begin-user-action", self.begin_user_action),
+                                buf.connect("end-user-action", self.end_user_action)]
+        self.textview.set_buffer(buf)
+        self.attach_images()
+
+    @lg.logging_decorator(logger)
+    def load_buffer(self, buf, content):
+        if content:
+            self.insert_note(buf, buf.get_start_iter(), note_format.loads(content))
+
+    @lg.logging_decorator(logger)
+    def insert_note(self, buf, position, note):
+        # inserts a note_format.Note at position, which ends up after it. The
+        # text goes in between the images, the tags are applied last
+        start = position.get_offset()
+        segments = note.text.split(note_format.IMAGE)
+        for index, segment in enumerate(segments):
+            if segment:
+                buf.insert(position, segment)
+            if index < len(note.images):
+                self.insert_image(buf, position, note.images[index])
+        for name, span_start, span_end in note.spans:
+            if self.tag_table.lookup(name) is not None:
+                buf.apply_tag_by_name(name, buf.get_iter_at_offset(start + span_start),
+                                      buf.get_iter_at_offset(start + span_end))
+
+    def insert_image(self, buf, position, image):
+        # a stored image becomes a child anchor that is filled in when it is
+        # scrolled to, a placeholder knows the size it has
+        if rich_text.is_reference(image):
+            placeholder = rich_text.reference_digest(image), 1, 1
+        elif rich_text.pixdata_size(image) == (rich_text.PLACEHOLDER_WIDTH, 1):
+            placeholder = rich_text.read_placeholder(rich_text.pixdata_pixels(image)[3])
+        else:
+            placeholder = None
+        if placeholder is None:
+            buf.insert_pixbuf(position, il.pixbuf_from_pixdata(image))
+        else:
+            buf.lazy_images.append(LazyImage(buf.create_child_anchor(position), *placeholder))
+
+    def buffer_note(self, start, end):
+        # the text between start and end of their buffer as a
+        # note_format.Note. Images that are not loaded are kept as references
+        # to the stored ones. Images that are still being decoded are left
+        # out, the note is saved again once they are in
+        buf = start.get_buffer()
+        base = start.get_offset()
+        text = buf.get_slice(start, end, True).decode('utf-8')
+        digests = dict((image.anchor, image.digest) for image in self.live_images(buf))
+        decoding = set()
+        for pending in buf.pending_images:
+            position = pending.get_iter()
+            if position is not None:
+                decoding.add(position.get_offset())
+        images = []
+        # offsets of U+FFFC characters that are not images, they are left out
+        dropped = []
+        offset = text.find(note_format.IMAGE)
+        while offset != -1:
+            position = buf.get_iter_at_offset(base + offset)
+            pixbuf = position.get_pixbuf()
+            anchor = position.get_child_anchor()
+            if base + offset in decoding:
+                dropped.append(offset)
+            elif pixbuf is not None:
+                images.append(il.pixdata_from_pixbuf(pixbuf))
+            elif anchor in digests:
+                images.append(rich_text.make_reference(digests[anchor]))
+            else:
+                dropped.append(offset)
+            offset = text.find(note_format.IMAGE, offset + 1)
+        spans = []
+        # tags that are on, with where they start
+        open_tags = dict((tag.props.name, 0) for tag in start.get_tags())
+        position = start.copy()
+        while position.forward_to_tag_toggle(None) and position.compare(end) < 0:
+            offset = position.get_offset() - base
+            for tag in position.get_toggled_tags(False):
+                if tag.props.name in open_tags:
+                    spans.append((tag.props.name, open_tags.pop(tag.props.name), offset))
+            for tag in position.get_toggled_tags(True):
+                open_tags[tag.props.name] = offset
+        spans.extend((name, offset, len(text)) for name, offset in open_tags.items())
+        spans = [span for span in spans if span[0] is not None and span[2] > span[1]]
+        if dropped:
+            for offset in reversed(dropped):
+                text = text[:offset] + text[offset + 1:]
+            moved = lambda offset: offset - bisect.bisect_left(dropped, offset)
+            spans = [(name, moved(span_start), moved(span_end)) for name, span_start, span_end in spans]
+        return note_format.Note(text, spans, images)
+
+    def live_images(self, buf=None):
+        # the LazyImages of buf, the shown buffer by default, whose anchors
+        # were not deleted
+        if buf is None:
+            buf = self.textbuffer
+        images = [image for image in buf.lazy_images if not image.anchor.get_deleted()]
+        buf.lazy_images = images
+        return images
+
+    def attach_images(self):
+        for image in self.live_images():
+            if image.widget is not None:
+                continue
+            image.widget = Gtk.Image()
+            # the note is laid out at its final size before any image is loaded
+            image.widget.set_size_request(image.width, image.height)
+            pixbuf = self.pixbufs.get(image.digest)
+            if pixbuf is not None:
+                image.widget.set_from_pixbuf(pixbuf)
+            image.widget.show()
+            self.textview.add_child_at_anchor(image.widget, image.anchor)
+        self.schedule_images()
+
+    def detach_images(self):
+        for image in self.textbuffer.lazy_images:
+            if image.widget is not None:
+                if image.widget.get_parent() is not None:
+                    self.textview.remove(image.widget)
+                image.widget = None
+
+    def schedule_images(self, *args):
+        if self.images_id is None:
+            self.images_id = GLib.idle_add(self.update_images)
+
+    def update_images(self):
+        # loads the images within a screen of the viewport, they are what is
+        # shown or what scrolling shows next
+        self.images_id = None
+        rect = self.textview.get_visible_rect()
+        top = rect.y - rect.height
+        bottom = rect.y + 2 * rect.height
+        shown = set()
+        missing = []
+        now = GLib.get_monotonic_time()
+        for image in self.live_images():
+            location = self.textview.get_iter_location(self.textbuffer.get_iter_at_child_anchor(image.anchor))
+            if location.y + image.height < top or location.y > bottom:
+                continue
+            shown.add(image.digest)
+            if image.digest in self.pixbufs:
+                self.pixbufs[image.digest] = self.pixbufs.pop(image.digest)
+            elif image.digest not in self.requested or now - self.requested[image.digest] > IMAGE_REQUEST_TIMEOUT:
+                self.requested[image.digest] = now
+                missing.append(image.digest)
+        self.shown_digests = shown
+        if missing and self.get_images is not None:
+            self.get_images(missing, self.on_images)
+        self.evict_images()
+        return False
+
+    def on_images(self, result):
+        digests, pixbufs = result
+        for digest in digests:
+            self.requested.pop(digest, None)
+        for digest, pixbuf in pixbufs.items():
+            self.pixbufs[digest] = pixbuf
+            self.pixbufs_size += pixbuf.get_rowstride() * pixbuf.get_height()
+        for image in self.live_images():
+            if image.widget is not None and image.digest in pixbufs:
+                image.widget.set_from_pixbuf(pixbufs[image.digest])
+        self.evict_images()
+
+    def evict_images(self):
+        # drops the pixels of the images least recently near the viewport
+        # until the rest fits IMAGE_BUDGET, their widgets keep the size
+        for digest in list(self.pixbufs):
+            if self.pixbufs_size <= IMAGE_BUDGET:
+                break
+            if digest in self.shown_digests:
+                continue
+            pixbuf = self.pixbufs.pop(digest)
+            self.pixbufs_size -= pixbuf.get_rowstride() * pixbuf.get_height()
+            for image in self.textbuffer.lazy_images:
+                if image.digest == digest and image.widget is not None:
+                    image.widget.clear()
+
+    @lg.logging_decorator(logger)
+    def buffer_fingerprint(self):
+        # identifies the text the undo history applies to
+        text = self.textbuffer.get_text(self.textbuffer.get_start_iter(),
+                                        self.textbuffer.get_end_iter(), True)
+        return '%08x%08x' % (self.textbuffer.get_char_count() & 0xffffffff,
+                             zlib.crc32(text) & 0xffffffff)
+
+    @lg.logging_decorator(logger)
+    def close_history(self):
+        # the history of the note that is left is moved to its journal
+        if self.note_id is not None:
+            self.undo_stack.close(self.buffer_fingerprint())
+        self.redo_stack = []
+
+    @lg.logging_decorator(logger)
+    def open_history(self):
+        if self.note_id is None:
+            self.undo_stack = um.UndoHistory()
+        else:
+            self.undo_stack = um.UndoHistory(um.journal_path(self.note_id), self.buffer_fingerprint())
+
+    def is_busy(self, note_id, buf):
+        # a buffer the cache must not drop, its edits or images would be lost
+        if buf.pending_images:
+            return True
+        return self.is_unsaved is not None and self.is_unsaved(note_id)
+
+    @lg.logging_decorator(logger)
+    def stash_buffer(self):
+        # keeps the buffer of the note that is being left in the cache. A
+        # buffer that is still loading is dropped, saving it saved its tail
+        if self.chunked_load is not None:
+            self.cancel_load()
+            return
+        if self.note_id is not None:
+            self.buffer_cache.put(self.note_id, self.textbuffer, self.buffer_size)
 
     @lg.logging_decorator(logger)
     def get_text(self,start=None,end=None):
+        # the stored content of the buffer, see note_format
+        whole = not start and not end
         if not start:
             start = self.textbuffer.get_start_iter()
         if not end:
             end = self.textbuffer.get_end_iter()
-        return self.textbuffer.serialize(self.textbuffer,
-                                         self.serialized_format,
-                                         start,
-                                         end)
+        note = self.buffer_note(start, end)
+        if whole and self.chunked_load is not None:
+            # the part that is not loaded yet is saved as it was read
+            for piece in self.chunked_load.pieces:
+                piece.images = [rich_text.restore_reference(image) for image in piece.images]
+            note = note_format.join_notes([note] + self.chunked_load.pieces)
+        text = note_format.dumps(note)
+        if whole:
+            self.buffer_size = len(text)
+        return text
+
+    @lg.logging_decorator(logger)
+    def get_note_text(self, note_id):
+        # (utf-8 text, stored content) of a note that has a buffer, the shown
+        # one or a cached one. None if it has none
+        if note_id == self.note_id:
+            return self.get_clean_text(), self.get_text()
+        buf = self.buffer_cache.peek(note_id)
+        if buf is None:
+            return None
+        start, end = buf.get_bounds()
+        return buf.get_text(start, end, False), note_format.dumps(self.buffer_note(start, end))
 
     @lg.logging_decorator(logger)
     def get_clean_text(self):
@@ -203,18 +695,105 @@ class Editor(Gtk.Grid):
                                         self.textbuffer.get_end_iter(), False)
 
     @lg.logging_decorator(logger)
-    def set_text(self, content):
-        self.textbuffer.set_text("")
-        if content != "":
-            
-            self.textbuffer.deserialize(self.textbuffer,
-                                        self.deserialized_format,
-                                        self.textbuffer.get_start_iter(),
-                                        content.encode("iso-8859-1"))
-            self.undo_stack = []
-            self.redo_stack = []
-        else:
-            pass
+    def set_text(self, content, note_id=None):
+        # shows content in a new buffer, the buffer that is left is cached
+        self.loading = True
+        try:
+            self.close_history()
+            self.stash_buffer()
+            self.note_id = note_id
+            buf = self.new_buffer()
+            self.buffer_size = len(content or "")
+            if self.buffer_size > LARGE_NOTE_BYTES:
+                self.load_large(buf, content)
+                return
+            self.load_buffer(buf, content)
+            self.activate_buffer(buf)
+            self.open_history()
+        finally:
+            self.loading = False
+
+    @lg.logging_decorator(logger)
+    def load_large(self, buf, content):
+        # shows the first chunk of a large note right away, the rest is added
+        # in idle time and can be edited around. The undo journal is opened
+        # once the whole note is in, its fingerprint is of the whole note
+        note = note_format.loads(content)
+        pieces = note_format.split_note(note, LOAD_CHUNK_CHARS)
+        self.insert_note(buf, buf.get_start_iter(), pieces.pop(0))
+        self.activate_buffer(buf)
+        self.undo_stack = um.UndoHistory()
+        load = ChunkedLoad(buf, pieces, len(note.text))
+        load.source_id = GLib.idle_add(self.load_next_chunk, load)
+        self.chunked_load = load
+        self.load_progress.set_fraction(0.0)
+        self.load_progress.show()
+
+    def load_next_chunk(self, load):
+        if load is not self.chunked_load:
+            # cancelled, the source is gone already
+            return False
+        if load.pieces:
+            piece = load.pieces.pop(0)
+            for handler in self.buffer_handlers:
+                self.textbuffer.handler_block(handler)
+            try:
+                self.insert_note(load.buf, load.buf.get_iter_at_mark(load.mark), piece)
+            finally:
+                for handler in self.buffer_handlers:
+                    self.textbuffer.handler_unblock(handler)
+            self.attach_images()
+            load.loaded += len(piece.text)
+            self.load_progress.set_fraction(min(1.0, float(load.loaded) / max(load.size, 1)))
+        if load.pieces:
+            return True
+        # a note that fits in one piece finishes on the first call
+        load.source_id = None
+        self.cancel_load()
+        if not self.undo_stack:
+            self.open_history()
+        return False
+
+    def cancel_load(self):
+        # stops loading the note, the buffer keeps what was loaded
+        load, self.chunked_load = self.chunked_load, None
+        if load is None:
+            return
+        if load.source_id is not None:
+            GLib.source_remove(load.source_id)
+        load.buf.delete_mark(load.mark)
+        self.load_progress.hide()
+
+    @lg.logging_decorator(logger)
+    def show_note(self, note_id, get_content):
+        # shows the cached buffer of the note, get_content(note_id) is only
+        # called when there is none
+        entry = self.buffer_cache.pop(note_id)
+        if entry is None:
+            self.set_text(get_content(note_id), note_id)
+            return
+        self.close_history()
+        self.stash_buffer()
+        self.note_id = note_id
+        buf, self.buffer_size = entry
+        self.activate_buffer(buf)
+        self.open_history()
+
+    @lg.logging_decorator(logger)
+    def prefetch(self, note_id, content):
+        # builds the buffer of a note that is likely to be shown next, large
+        # notes are left to load in chunks when they are shown
+        if note_id == self.note_id or note_id in self.buffer_cache:
+            return
+        if content and len(content) > LARGE_NOTE_BYTES:
+            return
+        buf = self.new_buffer()
+        self.load_buffer(buf, content)
+        self.buffer_cache.put(note_id, buf, len(content or ""))
+
+    def mark_dirty(self):
+        if self.note_id is not None and not self.loading:
+            self.emit('modified', self.note_id)
 
     @lg.logging_decorator(logger)
     def toggle_tag(self, widget, tag):
@@ -225,13 +804,14 @@ class Editor(Gtk.Grid):
         limits = self.textbuffer.get_selection_bounds()
         if len(limits) != 0:
             start, end = limits
+            self.mark_dirty()
             if self.format_toolbar.buttons[tag].get_active():
                 self.textbuffer.apply_tag(self.tags[tag], start, end)
                 ##########
                 #undo part
                 ##########
                 if not self.undo_in_progress:
-                    redo_stack = []
+                    self.redo_stack = []
                 if self.not_undoable_action:
                     return
                 undo_action = UndoableInsertTag(tag,start,end)
@@ -243,7 +823,7 @@ class Editor(Gtk.Grid):
                 #undo part
                 ##########
                 if not self.undo_in_progress:
-                    redo_stack = []
+                    self.redo_stack = []
                 if self.not_undoable_action:
                     return
                 undo_action = UndoableDeleteTag(tag,start,end)
@@ -259,6 +839,7 @@ class Editor(Gtk.Grid):
         limits = self.textbuffer.get_selection_bounds()
         if len(limits) != 0:
             start, end = limits
+            self.mark_dirty()
             if tag == 'header':
                 self.textbuffer.remove_tag(self.tags['title'], start, end)
             elif tag == 'title':
@@ -269,7 +850,7 @@ class Editor(Gtk.Grid):
             #undo part
             ##########
             if not self.undo_in_progress:
-                redo_stack = []
+                self.redo_stack = []
             if self.not_undoable_action:
                 return
             undo_action = UndoableInsertTag(tag,start,end)
@@ -297,10 +878,12 @@ class Editor(Gtk.Grid):
             else:
                 self.just_buttons[tag] = True
                 self.textbuffer.apply_tag(self.tags[tag],start_iter,end_iter)
+        self.mark_dirty()
         self.textview.grab_focus()
 
     @lg.logging_decorator(logger)
     def insert_with_tags(self, buf, start_iter, data, data_len):
+        self.mark_dirty()
         end = self.textbuffer.props.cursor_position
         #creating new start iter because the provided one
         #gets invalidated for some reason
@@ -344,7 +927,7 @@ class Editor(Gtk.Grid):
         start = self.textbuffer.get_iter_at_offset(current_cursor_position - data_len)
         undo_action = UndoableInsert(start, data, data_len)
         try:
-            prev_insert = self.undo_stack.pop()
+            prev_insert = self.undo_stack.pop_recent()
         except IndexError:
             self.undo_stack.append(undo_action)
             return
@@ -393,6 +976,7 @@ class Editor(Gtk.Grid):
 
     @lg.logging_decorator(logger)
     def delete(self,buff, start,end):
+        self.mark_dirty()
         if buff.get_text(start,end,False) == '\t' and \
         start.get_line_offset() <= self.current_indent_level and \
         not self.not_undoable_action:
@@ -422,7 +1006,7 @@ class Editor(Gtk.Grid):
             return
         undo_action = UndoableDelete(self.textbuffer,start,end)
         try:
-            prev_delete = self.undo_stack.pop()
+            prev_delete = self.undo_stack.pop_recent()
         except IndexError:
             self.undo_stack.append(undo_action)
             return
@@ -435,7 +1019,7 @@ class Editor(Gtk.Grid):
                 prev_delete.text += undo_action.text
                 prev_delete.end  += (undo_action.end - undo_action.start)
             else:
-                prev_delete = "{}{}".format(undo_action.text,prev_delete.text)
+                prev_delete.text = "{}{}".format(undo_action.text,prev_delete.text)
                 prev_delete.start = undo_action.start
             self.undo_stack.append(prev_delete)
         else:
@@ -450,73 +1034,122 @@ class Editor(Gtk.Grid):
             self.offset_after_tab_deletion = None
 
     @lg.logging_decorator(logger)
-    def undo(self,widget):
-        if not self.undo_stack:
+    def paste_clipboard(self, textview):
+        # large plain text skips the default paste, rich text copied from a
+        # note keeps its tags
+        clipboard = textview.get_clipboard(Gdk.SELECTION_CLIPBOARD)
+        if clipboard.wait_is_rich_text_available(self.textbuffer):
+            return
+        text = clipboard.wait_for_text()
+        if text is None or len(text) <= BULK_INSERT_BYTES:
+            return
+        textview.stop_emission_by_name('paste-clipboard')
+        self.textbuffer.begin_user_action()
+        self.textbuffer.delete_selection(True, textview.get_editable())
+        self.insert_bulk(text)
+        self.textbuffer.end_user_action()
+
+    @lg.logging_decorator(logger)
+    def drag_data_received(self, textview, context, x, y, data, info, time):
+        # text dragged in from other applications, a drag inside the note is a
+        # move and is left to GTK
+        if Gtk.drag_get_source_widget(context) is textview:
+            return
+        text = data.get_text()
+        if text is None or len(text) <= BULK_INSERT_BYTES:
             return
+        textview.stop_emission_by_name('drag-data-received')
+        x, y = textview.window_to_buffer_coords(Gtk.TextWindowType.WIDGET, x, y)
+        position = textview.get_iter_at_location(x, y)
+        # newer PyGObject returns (found, iter)
+        if isinstance(position, tuple):
+            position = position[1]
+        self.textbuffer.place_cursor(position)
+        self.textbuffer.begin_user_action()
+        self.insert_bulk(text)
+        self.textbuffer.end_user_action()
+        Gtk.drag_finish(context, True, False, time)
+
+    def insert_bulk(self, text):
+        # inserts text at the cursor in chunks with the handlers blocked. The
+        # active formatting is applied once to the whole range and the undo
+        # history gets one UndoableRangeInsert, nothing is copied for it
+        buf = self.textbuffer
+        text = text.decode('utf-8', 'replace')
+        position = buf.get_iter_at_mark(buf.get_insert())
+        start = position.get_offset()
+        at_line_start = position.get_line_offset() == 0
+        for handler in self.buffer_handlers:
+            buf.handler_block(handler)
+        try:
+            for chunk_start in xrange(0, len(text), BULK_CHUNK_CHARS):
+                buf.insert(position, text[chunk_start:chunk_start + BULK_CHUNK_CHARS])
+        finally:
+            for handler in self.buffer_handlers:
+                buf.handler_unblock(handler)
+        end = position.get_offset()
+        tags = [tag for tag in self.format_toolbar.buttons if self.format_toolbar.buttons[tag].get_active()]
+        if at_line_start:
+            tags += [tag for tag in self.just_buttons if self.just_buttons[tag]]
+        for tag in tags:
+            buf.apply_tag(self.tags[tag], buf.get_iter_at_offset(start), buf.get_iter_at_offset(end))
+        self.redo_stack = []
+        self.undo_stack.append(UndoableRangeInsert(start, end, tags))
+        buf.place_cursor(buf.get_iter_at_offset(end))
+        self.textview.scroll_mark_onscreen(buf.get_insert())
+        self.mark_dirty()
+
+    @lg.logging_decorator(logger)
+    def begin_user_action(self, buf):
+        self.undo_stack.begin()
+
+    @lg.logging_decorator(logger)
+    def end_user_action(self, buf):
+        self.undo_stack.end(compact_actions)
+
+    @lg.logging_decorator(logger)
+    def replay(self, item, apply_action, redo):
+        # applies a record or a whole transaction with the buffer handlers
+        # blocked, they would only find out that nothing is to be recorded.
+        # The cursor goes where the last change that moves it puts it
+        actions = item.actions if isinstance(item, um.Transaction) else [item]
+        if not redo:
+            actions = reversed(actions)
         self.not_undoable_action = True
         self.undo_in_progress = True
+        for handler in self.buffer_handlers:
+            self.textbuffer.handler_block(handler)
+        cursor = None
+        try:
+            for action in actions:
+                offset = apply_action(self.textbuffer, action)
+                if offset is not None:
+                    cursor = offset
+        finally:
+            for handler in self.buffer_handlers:
+                self.textbuffer.handler_unblock(handler)
+            self.not_undoable_action = False
+            self.undo_in_progress = False
+        if cursor is not None:
+            self.textbuffer.place_cursor(self.textbuffer.get_iter_at_offset(cursor))
+        self.mark_dirty()
+        self.textview.grab_focus()
+
+    @lg.logging_decorator(logger)
+    def undo(self,widget):
+        if not self.undo_stack:
+            return
         undo_action = self.undo_stack.pop()
         self.redo_stack.append(undo_action)
-        if isinstance(undo_action,UndoableInsert):
-            start = self.textbuffer.get_iter_at_offset(undo_action.offset)
-            end = self.textbuffer.get_iter_at_offset(undo_action.offset+undo_action.len)
-            self.textbuffer.delete(start,end)
-            self.textbuffer.place_cursor(start)
-        elif isinstance(undo_action, UndoableInsertTag):
-            start = self.textbuffer.get_iter_at_offset(undo_action.start)
-            end = self.textbuffer.get_iter_at_offset(undo_action.end)
-            self.textbuffer.remove_tag(self.tags[undo_action.tag],start,end)
-        elif isinstance(undo_action,UndoableDeleteTag):
-            start = self.textbuffer.get_iter_at_offset(undo_action.start)
-            end = self.textbuffer.get_iter_at_offset(undo_action.end)
-            self.textbuffer.apply_tag(self.tags[undo_action.tag],start,end)
-        else:
-            start = self.textbuffer.get_iter_at_offset(undo_action.start)
-            self.textbuffer.insert(start,undo_action.text)
-            end = self.textbuffer.get_iter_at_offset(undo_action.end)
-            for tag in undo_action.tags:
-                self.textbuffer.apply_tag(tag,start,end)
-            if undo_action.delete_key_used:
-                self.textbuffer.place_cursor(start)
-            else:
-                self.textbuffer.place_cursor(end)
-        self.textview.grab_focus()
-        self.not_undoable_action = False
-        self.undo_in_progress = False
+        self.replay(undo_action, revert_action, False)
 
     @lg.logging_decorator(logger)
     def redo(self,widget):
         if not self.redo_stack:
             return
-        self.not_undoable_action = True
-        self.undo_in_progress = True
         redo_action = self.redo_stack.pop()
         self.undo_stack.append(redo_action)
-        if isinstance(redo_action, UndoableInsert):
-            start = self.textbuffer.get_iter_at_offset(redo_action.offset)
-            self.textbuffer.insert(start,redo_action.text)
-            new_cursor_pos = self.textbuffer.get_iter_at_offset(redo_action.offset + redo_action.len)
-            for tag in redo_action.tags:
-                start = self.textbuffer.get_iter_at_offset(redo_action.offset)
-                end = self.textbuffer.get_iter_at_offset(redo_action.offset+redo_action.len)
-                self.textbuffer.apply_tag(tag,start,end)
-            self.textbuffer.place_cursor(new_cursor_pos)
-        elif isinstance(redo_action,UndoableInsertTag):
-            start = self.textbuffer.get_iter_at_offset(redo_action.start)
-            end = self.textbuffer.get_iter_at_offset(redo_action.end)
-            self.textbuffer.apply_tag(self.tags[redo_action.tag],start,end)
-        elif isinstance(redo_action,UndoableDeleteTag):
-            start = self.textbuffer.get_iter_at_offset(redo_action.start)
-            end = self.textbuffer.get_iter_at_offset(redo_action.end)
-            self.textbuffer.remove_tag(self.tags[redo_action.tag],start,end)
-        else:
-            start = self.textbuffer.get_iter_at_offset(redo_action.start)
-            end = self.textbuffer.get_iter_at_offset(redo_action.end)
-            self.textbuffer.delete(start,end)
-            self.textbuffer.place_cursor(start)
-        self.textview.grab_focus()
-        self.not_undoable_action = False
-        self.undo_in_progress = False
+        self.replay(redo_action, apply_action, True)
 
     @lg.logging_decorator(logger)
     def add_image(self, widget):
@@ -531,27 +1164,59 @@ class Editor(Gtk.Grid):
         image_filter.set_name("Image files")
         image_filter.add_mime_type("image/*")
         dialog.add_filter(image_filter)
+        dialog.set_select_multiple(True)
         response = dialog.run()
         if response == Gtk.ResponseType.ACCEPT:
-            image_path = dialog.get_file().get_path()
-            image = GdkPixbuf.Pixbuf.new_from_file(image_path)
-            image_format, width, height = GdkPixbuf.Pixbuf.get_file_info(
-                image_path)
-            if width > 800:
-                width = 800
-            if height > 640:
-                height = 640
-            if width > 800 and height > 640:
-                width = 800
-                height = 640
-            image = image.scale_simple(
-                width, height, GdkPixbuf.InterpType.BILINEAR)
-            current_position = self.textbuffer.props.cursor_position
-            cursor_iter = self.textbuffer.get_iter_at_offset(current_position)
-            self.textbuffer.insert_pixbuf(cursor_iter, image)
+            # the images go at the cursor in the order they were picked,
+            # each one as a placeholder until it is decoded
+            cursor_iter = self.textbuffer.get_iter_at_mark(self.textbuffer.get_insert())
+            for image_path in dialog.get_filenames():
+                pending = PendingImage(self.textbuffer, cursor_iter, self.note_id)
+                self.image_loader.load(image_path,
+                                       functools.partial(self.show_image, pending),
+                                       functools.partial(self.drop_image, pending))
+            self.mark_dirty()
 
         dialog.destroy()
 
+    def replace_image(self, pending, pixbuf):
+        # puts pixbuf, or nothing if it is None, in place of what is shown for
+        # the image. The note may have been left since, its buffer is then
+        # changed in the cache. Returns False if the image was deleted
+        start = pending.get_iter()
+        if start is None:
+            return False
+        end = start.copy()
+        end.forward_char()
+        active = pending.buf is self.textbuffer
+        if active:
+            for handler in self.buffer_handlers:
+                self.textbuffer.handler_block(handler)
+        try:
+            pending.buf.delete(start, end)
+            if pixbuf is not None:
+                # same length as before, the offsets in the undo history hold
+                pending.buf.insert_pixbuf(start, pixbuf)
+        finally:
+            if active:
+                for handler in self.buffer_handlers:
+                    self.textbuffer.handler_unblock(handler)
+        pending.pixbuf = pixbuf
+        if pending.note_id is not None:
+            self.emit('modified', pending.note_id)
+        return True
+
+    def show_image(self, pending, pixbuf, final):
+        if not self.replace_image(pending, pixbuf) or final:
+            pending.finish()
+        return False
+
+    def drop_image(self, pending, path, error):
+        self.logger.logger.error('Could not load the image {} ; ERROR MESSAGE > {}'.format(path, error))
+        self.replace_image(pending, None)
+        pending.finish()
+        return False
+
     @lg.logging_decorator(logger)
     def add_list(self,widget):
         if self.format_toolbar.list.get_active():
@@ -58,4 +58,9 @@ class Headerbar(Gtk.HeaderBar):
         self.delete_button.add(image)
         self.pack_end(self.delete_button)
 
+        # Search
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.set_placeholder_text("Search notes")
+        self.pack_end(self.search_entry)
+
         self.pack_start(box)
@@ -0,0 +1,110 @@
+from multiprocessing.pool import ThreadPool
+from gi.repository import GdkPixbuf, GLib
+from logger import logger as lg
+from core import rich_text
+
+#
+# Images picked for a note are decoded on a pool of threads, the main loop
+# only inserts the finished pixbufs.
+#
+# Every image is decoded at the size it is shown at with
+# new_from_file_at_scale, a large photo is never decoded at full size.
+# A thumbnail is decoded first and handed over right away, the display
+# rendition follows. Both keep the aspect ratio and are never scaled up.
+#
+# Images stored with a note are read back by load_stored on a worker with
+# its own database session, only for the part of the note that is shown.
+#
+
+THREADS = 2
+DISPLAY_SIZE = (800, 640)
+THUMBNAIL_SIZE = (160, 128)
+PLACEHOLDER_COLOR = 0xd4d4d4ff
+
+
+def fit(width, height, max_width, max_height):
+    # the largest size within max_width x max_height with the same aspect
+    # ratio, images smaller than that keep their size
+    scale = min(1.0, float(max_width) / width, float(max_height) / height)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def placeholder():
+    # shown where an image goes until its thumbnail is decoded. Every image
+    # gets its own so that it can be told apart from the others
+    pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, *THUMBNAIL_SIZE)
+    pixbuf.fill(PLACEHOLDER_COLOR)
+    return pixbuf
+
+
+def decode(path, on_rendition, on_failed):
+    # runs on the pool. on_rendition(pixbuf, final) is called on the main
+    # loop with the thumbnail and then with the display rendition
+    try:
+        image_format, width, height = GdkPixbuf.Pixbuf.get_file_info(path)
+        if image_format is None:
+            raise ValueError('{} is not an image'.format(path))
+        display_width, display_height = fit(width, height, *DISPLAY_SIZE)
+        thumbnail_width, thumbnail_height = fit(width, height, *THUMBNAIL_SIZE)
+        if (thumbnail_width, thumbnail_height) != (display_width, display_height):
+            thumbnail = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, thumbnail_width, thumbnail_height, True)
+            GLib.idle_add(on_rendition, thumbnail, False)
+        display = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, display_width, display_height, True)
+    except (GLib.Error, ValueError) as e:
+        GLib.idle_add(on_failed, path, e)
+        return
+    GLib.idle_add(on_rendition, display, True)
+
+
+def pixbuf_from_pixdata(image):
+    width, height, rowstride, pixels = rich_text.pixdata_pixels(image)
+    return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(pixels), GdkPixbuf.Colorspace.RGB,
+                                           True, 8, width, height, rowstride)
+
+
+def pixdata_from_pixbuf(pixbuf):
+    # the record a pixbuf is stored as, RGBA without row padding
+    if not pixbuf.get_has_alpha():
+        pixbuf = pixbuf.add_alpha(False, 0, 0, 0)
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    rowstride = pixbuf.get_rowstride()
+    pixels = pixbuf.get_pixels()
+    if rowstride != width * 4:
+        pixels = ''.join(pixels[row * rowstride:row * rowstride + width * 4] for row in xrange(height))
+    return rich_text.make_pixdata(width, height, pixels)
+
+
+def load_stored(database, digests):
+    # runs on a worker, returns the digests and {digest: pixbuf} of the ones
+    # that are still stored. It returns on errors too, the editor does not
+    # ask for the digests again until it has the answer
+    pixbufs = {}
+    try:
+        for digest, image in database.load_images(digests).items():
+            pixbufs[digest] = pixbuf_from_pixdata(image)
+    except Exception as e:
+        ImageLoader.logger.logger.error('Could not load the stored images ; ERROR MESSAGE > {}'.format(e))
+    return digests, pixbufs
+
+
+class ImageLoader(object):
+
+    logger = lg.Logger('ImageLoader')
+
+    def __init__(self, threads=THREADS):
+        self.pool = ThreadPool(threads)
+
+    def load(self, path, on_rendition, on_failed):
+        # queues the image, any number can be waiting at once
+        self.pool.apply_async(decode, (path, on_rendition, on_failed))
+
+    @lg.logging_decorator(logger)
+    def close(self, wait=False):
+        # images that are still queued are dropped, unless wait is set. Their
+        # callbacks are then queued on the main loop when this returns
+        if wait:
+            self.pool.close()
+            self.pool.join()
+        else:
+            self.pool.terminate()
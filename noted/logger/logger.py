@@ -1,28 +1,152 @@
 import logging
-from gi.repository import GLib
+import logging.handlers
+import functools
+import threading
+import random
+import atexit
+import Queue
+import os
+from core import instrumentation
+from core import paths
+
+#
+# Every module of the GUI asks for a Logger, they all share the 'Main'
+# logger. The core logs to logging.getLogger(__name__) and knows nothing of
+# this module, setup puts the one handler on the root logger so that both end
+# up in the log file. Records are put on a queue and written to the rotating
+# log file by a writer thread, so the caller never waits for the disk.
+#
+# Successful calls of functions wrapped by logging_decorator are only logged
+# when tracing is on, NOTED_TRACE=1 traces every call and NOTED_TRACE=0.05
+# traces a sample of 5% of them. NOTED_LOG_LEVEL sets the level of the file.
+#
+# The decorator also times every call for the stats kept in
+# core.instrumentation, NOTED_STATS=0 turns the timing off.
+#
+
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+MAX_BYTES = 1024 * 1024
+BACKUP_COUNT = 3
+QUEUE_SIZE = 10000
+
+tracing = False
+sample_rate = 1.0
+
+setup_lock = threading.Lock()
+writer = None
+
+
+class QueueHandler(logging.Handler):
+	# hands the records to the writer thread. When the queue is full the
+	# record is dropped rather than blocking the caller
+
+	def __init__(self, queue):
+		logging.Handler.__init__(self)
+		self.queue = queue
+
+	def emit(self, record):
+		try:
+			# the message is built now, the arguments could change later on
+			record.msg = record.getMessage()
+			record.args = None
+			if record.exc_info:
+				record.exc_text = logging.Formatter().formatException(record.exc_info)
+				record.exc_info = None
+			self.queue.put_nowait(record)
+		except Queue.Full:
+			pass
+		except Exception:
+			self.handleError(record)
+
+
+class LogWriter(threading.Thread):
+
+	def __init__(self, queue, handler):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.queue = queue
+		self.handler = handler
+
+	def run(self):
+		while True:
+			record = self.queue.get()
+			if record is None:
+				break
+			self.handler.handle(record)
+
+	def stop(self):
+		# writes the records that are still queued
+		self.queue.put(None)
+		self.join()
+		self.handler.close()
+
+
+def configure(level=None, trace=None, sample=None):
+	global tracing, sample_rate
+	if level is not None:
+		logging.getLogger('Main').setLevel(level)
+		logging.getLogger('core').setLevel(level)
+	if trace is not None:
+		tracing = trace
+	if sample is not None:
+		sample_rate = sample
+
+
+def setup():
+	# creates the shared handler and the writer thread the first time it is called
+	global writer
+	with setup_lock:
+		main_logger = logging.getLogger('Main')
+		if writer is not None:
+			return main_logger
+		logging_path = os.path.join(paths.data_dir(create=True), 'Main')
+		handler = logging.handlers.RotatingFileHandler(logging_path, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT)
+		formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+		handler.setFormatter(formatter)
+		queue = Queue.Queue(QUEUE_SIZE)
+		logging.getLogger().addHandler(QueueHandler(queue))
+		writer = LogWriter(queue, handler)
+		writer.start()
+		atexit.register(writer.stop)
+
+		level = os.environ.get('NOTED_LOG_LEVEL', 'INFO').upper()
+		trace = os.environ.get('NOTED_TRACE')
+		if trace:
+			configure(level=TRACE, trace=True, sample=float(trace))
+		else:
+			configure(level=logging.getLevelName(level))
+		return main_logger
+
 
 class Logger(object):
 
-	def __init__(self):
-		self.logger = logging.getLogger('Main')
-		self.logger.setLevel(logging.DEBUG)
-		logging_path = "{}/Noted/Main".format(GLib.get_user_data_dir())
-		self.handler = logging.FileHandler(logging_path)
-		formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
-		self.handler.setFormatter(formatter)
-		self.logger.addHandler(self.handler)
+	def __init__(self, subsystem='Main'):
+		# subsystem groups the stats of the functions decorated with this logger
+		self.subsystem = subsystem
+		self.logger = setup()
 
 
 def logging_decorator(logger):
 	def decorator(function):
+		stat = instrumentation.get_stat(logger.subsystem, function.__name__)
+		@functools.wraps(function)
 		def wrapper(*args,**kwargs):
+			if instrumentation.enabled:
+				start = instrumentation.timer()
 			try:
 				result = function(*args,**kwargs)
-				logger.logger.debug('Succesfully completed {}'.format(function.__name__))
-				return result
 			except Exception as e:
-				logger.logger.debug('There was a problem running the function {} ; ERROR MESSAGE > {}'.format(function.__name__,e))
+				stat.record_error()
+				logger.logger.error('There was a problem running the function {} ; ERROR MESSAGE > {}'.format(function.__name__,e))
 				#NOTE figure out how to close on exception
-				raise e
+				raise
+			finally:
+				if instrumentation.enabled:
+					stat.record(instrumentation.timer() - start)
+			if tracing and (sample_rate >= 1.0 or random.random() < sample_rate):
+				logger.logger.log(TRACE, 'Succesfully completed %s', function.__name__)
+			return result
 		return wrapper
-	return decorator
\ No newline at end of file
+	return decorator
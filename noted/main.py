@@ -4,17 +4,26 @@ from gi.repository import Gtk, Gdk, GLib
 import sidebar as sb
 import headerbar as hb
 import editor
+import image_loader
+import autosave
+import worker
+import threading
+import undo_manager
 import shelve
 from dialogs import notebook_dialog as nd
 from dialogs import delete_dialog as dd
-from database import Database
-import os
-import subprocess
+from core.database import Database
+from core import migrations
+from core import note_format
+from core import sqlite_profile
+from core import paths
+import signal
 from logger import logger as lg
+from core import instrumentation
 
 class MainWindow(Gtk.Window):
 
-    logger = lg.Logger()
+    logger = lg.Logger('MainWindow')
 
     def __init__(self):
         Gtk.Window.__init__(self, title="Noted")
@@ -38,6 +47,9 @@ class MainWindow(Gtk.Window):
         # Delete Button
         hbar.delete_button.connect("clicked", self.delete_note)
 
+        # Search
+        hbar.search_entry.connect("search-changed", self.search_notes)
+
         #shortcuts
         self.connect("key-press-event",self.on_key_press)
 
@@ -51,6 +63,7 @@ class MainWindow(Gtk.Window):
         self.sidebar.sidebar_options['new'].connect('activate',self.create_note)
         self.sidebar.sidebar_options['delete'].connect('activate',self.delete_note)
         self.sidebar.sidebar_options['restore'].connect('activate',self.restore_note)
+        self.sidebar.sidebar_options['empty'].connect('activate',self.empty_trash)
 
         
         # EDITOR
@@ -59,6 +72,17 @@ class MainWindow(Gtk.Window):
         # loads the storage file and creates the dict db
         self.start_database()
 
+        # AUTOSAVE
+        # row of the note shown in the editor
+        self.current_row = None
+        # notes whose buffers are built in idle time
+        self.prefetch_ids = []
+        self.prefetch_id = None
+        self.autosave = autosave.Autosave(self)
+        self.editor.is_unsaved = self.autosave.tracker.is_dirty
+        self.editor.connect('modified', self.autosave.schedule)
+        GLib.timeout_add_seconds(sqlite_profile.MAINTENANCE_SECONDS, self.maintain_database)
+
         main_window.attach(self.sidebar, 0, 0, 1, 2)
         main_window.attach(self.editor, 1, 0, 2, 1)
         self.add(main_window)
@@ -68,20 +92,21 @@ class MainWindow(Gtk.Window):
         if event.button == 3:
             try:
                 selected_iter = self.sidebar.get_selected()
-                selected = self.sidebar.store[selected_iter][0]
                 parent_iter = self.sidebar.get_parent(selected_iter)
+                # the notebook of the row, by id so that a notebook the user
+                # named Trash is not taken for it
                 if parent_iter != None:
-                    parent = self.sidebar.store[parent_iter][0]
-                else:
-                    parent = None
-                if parent == 'Trash' or selected == 'Trash':
-                    self.sidebar.sidebar_options['new'].set_sensitive(False)
-                    self.sidebar.sidebar_options['delete'].set_sensitive(True)
-                    self.sidebar.sidebar_options['restore'].set_sensitive(True)
+                    notebook_id = self.sidebar.get_id(parent_iter)
                 else:
-                    self.sidebar.sidebar_options['restore'].set_sensitive(False)
-                    self.sidebar.sidebar_options['new'].set_sensitive(True)
-                    self.sidebar.sidebar_options['delete'].set_sensitive(True)
+                    notebook_id = self.sidebar.get_id(selected_iter)
+                in_trash = notebook_id == self.database.get_trash_id()
+                self.sidebar.sidebar_options['new'].set_sensitive(not in_trash)
+                self.sidebar.sidebar_options['delete'].set_sensitive(True)
+                self.sidebar.sidebar_options['restore'].set_sensitive(in_trash)
+                # notes leave the Trash by restoring them
+                self.sidebar.sidebar_options['move'].set_sensitive(not in_trash and parent_iter is not None)
+                self.sidebar.sidebar_options['empty'].set_sensitive(in_trash)
+                self.sidebar.set_move_targets(self.move_notes)
                 self.sidebar.menu.popup(None,None,None,None,event.button,event.time)
             except TypeError:
                 #there was no selection when the click occured
@@ -94,7 +119,7 @@ class MainWindow(Gtk.Window):
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
             name = dialog.entry.get_text()
-            if name != '' and name != 'Trash':
+            if name != '' and name != migrations.TRASH_NAME:
                 self.sidebar.add_notebook(name, self.notebook_id)
                 self.database.create_notebook(name,self.notebook_id)
                 self.notebook_id += 1
@@ -102,6 +127,7 @@ class MainWindow(Gtk.Window):
 
     @lg.logging_decorator(logger)
     def create_note(self, widget):
+        self.autosave.flush()
         if self.sidebar.add_item("New Note", self.id):
             self.editor.set_text("")
             parent_id = self.sidebar.get_id(self.sidebar.get_selected())
@@ -110,84 +136,183 @@ class MainWindow(Gtk.Window):
 
     @lg.logging_decorator(logger)
     def delete_note(self, widget):
+        # pending edits are saved first so that they end up in the trash too
+        self.autosave.flush()
         dialog = dd.DeleteDialog(self)
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
-            result = self.sidebar.remove_item()
+            rows = self.sidebar.get_selected_rows()
+            note_rows = [row for row in rows if row.get_path().get_depth() > 1]
+            notebook_rows = [row for row in rows if row.get_path().get_depth() == 1]
             self.editor.set_text("")
-            if result is not None:
-                note_id, parent_id = result
-                if note_id is not None:
-                    self.database.delete_note(note_id)
-                else:
-                    self.database.delete_notebook(parent_id)
+            # all selected notes are trashed by one call
+            if note_rows:
+                note_ids = [self.sidebar.get_id(row.get_path()) for row in note_rows]
+                self.database.trash_notes(note_ids)
+                for row in note_rows:
+                    self.sidebar.remove_item(self.sidebar.get_iter_from_path(row.get_path()))
+                for note_id in note_ids:
+                    self.editor.buffer_cache.invalidate(note_id)
+                    undo_manager.remove_journal(note_id)
+            for row in notebook_rows:
+                result = self.sidebar.remove_item(self.sidebar.get_iter_from_path(row.get_path()))
+                if result is not None:
+                    self.database.delete_notebook(result[1])
+                    self.editor.buffer_cache.clear()
         dialog.destroy()
 
     @lg.logging_decorator(logger)        
     def restore_note(self,widget):
-        selected = self.sidebar.get_selected()
-        if self.sidebar.store[selected][0] != 'Trash':
-            idd = self.sidebar.get_id(self.sidebar.get_selected())
-            note = self.database.get_note(idd)
-            notebook_id,notebook_name,result = self.database.restore_note(idd)
-            self.sidebar.remove_item()
-            if result:
-                parent_iter = self.sidebar.add_notebook(notebook_name,notebook_id)
-                self.sidebar.add_item(note.name,idd,parent_iter)
-                self.editor.set_text("")
+        self.autosave.flush()
+        # the selected notes of the trash are restored by one call
+        trash_id = self.database.get_trash_id()
+        rows = [row for row in self.sidebar.get_selected_rows() if row.get_path().get_depth() > 1 and
+                self.sidebar.get_id(self.sidebar.get_parent(self.sidebar.get_iter_from_path(row.get_path()))) == trash_id]
+        titles = {}
+        for row in rows:
+            titles[self.sidebar.get_id(row.get_path())] = self.sidebar.store[row.get_path()][0]
+        if not titles:
+            return
+        restored = self.database.restore_notes(list(titles))
+        for row in rows:
+            self.sidebar.remove_item(self.sidebar.get_iter_from_path(row.get_path()))
+        for notebook_id, notebook_name, created, note_ids in restored:
+            if created:
+                parent_iter = self.sidebar.add_notebook(notebook_name, notebook_id)
+            else:
+                parent_iter = self.sidebar.find_notebook(notebook_id)
+            for idd in note_ids:
+                self.sidebar.add_item(titles[idd], idd, parent_iter)
+        self.editor.set_text("")
+
+    @lg.logging_decorator(logger)
+    def move_notes(self, widget, notebook_id):
+        # the selected notes are moved by one call
+        self.autosave.flush()
+        trash_id = self.database.get_trash_id()
+        rows = []
+        for row in self.sidebar.get_selected_rows():
+            if row.get_path().get_depth() > 1:
+                parent_id = self.sidebar.get_id(self.sidebar.get_parent(self.sidebar.get_iter_from_path(row.get_path())))
+                if parent_id not in (trash_id, notebook_id):
+                    rows.append(row)
+        if not rows:
+            return
+        note_ids = [self.sidebar.get_id(row.get_path()) for row in rows]
+        self.database.move_notes(note_ids, notebook_id)
+        notebook_iter = self.sidebar.find_notebook(notebook_id)
+        for row in rows:
+            self.sidebar.move_item(self.sidebar.get_iter_from_path(row.get_path()), notebook_iter)
+        if self.editor.note_id in note_ids:
+            # the row of the shown note is a new one, or not loaded at all
+            row = self.sidebar.find_note(self.editor.note_id)
+            if row is not None:
+                self.current_row = self.sidebar.get_row_reference(self.sidebar.get_path(row))
             else:
-                #means we have to add to an existing notebook
-                #this part should be moved to the sidebar module given that is processing done by it
-                children = self.sidebar.store.iter_n_children(None)
-                current = 0
-                current_child = self.sidebar.store.iter_children(None)
-                while current < children:
-                    item = self.sidebar.store[current_child]
-                    if item[0] == notebook_name and item[1] == notebook_id:
-                        self.sidebar.add_item(note.name,idd,item.iter)
-                    current_child = self.sidebar.store.iter_next(item.iter)
-                    current += 1
                 self.editor.set_text("")
+                self.current_row = None
+
+    @lg.logging_decorator(logger)
+    def empty_trash(self, widget):
+        dialog = dd.DeleteDialog(self)
+        response = dialog.run()
+        if response == Gtk.ResponseType.OK:
+            self.autosave.flush()
+            note_ids = self.database.empty_trash()
+            self.sidebar.remove_children(self.sidebar.trash_iter)
+            if self.editor.note_id in note_ids:
+                self.editor.set_text("")
+                self.current_row = None
+            for note_id in note_ids:
+                self.editor.buffer_cache.invalidate(note_id)
+                undo_manager.remove_journal(note_id)
+        dialog.destroy()
 
     @lg.logging_decorator(logger)    
     def show_note(self, treeview, path, col):
+        # the note that is being left is saved before the buffer is replaced
+        self.autosave.flush()
         if len(path) > 1:
-            parent_iter = self.sidebar.get_parent(treeview.get_selection().get_selected()[1])
-            parent_id = self.sidebar.get_id(parent_iter)
-            note_id = self.sidebar.get_id(path)
-            content = self.database.get_note(note_id).content
-            self.editor.set_text(content)
+            store_path = self.sidebar.to_store_path(path)
+            note_id = self.sidebar.get_id(store_path)
+            if note_id == sb.PLACEHOLDER:
+                self.sidebar.load_page(self.sidebar.get_parent(self.sidebar.get_iter_from_path(store_path)))
+                return
+            self.editor.show_note(note_id, self.database.get_note_layout)
+            self.current_row = self.sidebar.get_row_reference(store_path)
+            self.schedule_prefetch(store_path)
         else:
             self.editor.set_text("")
+            self.current_row = None
             if treeview.row_expanded(path) is False:
                 treeview.expand_row(path, True)
             else:
                 treeview.collapse_row(path)
     @lg.logging_decorator(logger)
+    def schedule_prefetch(self, path):
+        # the notes next to the one that was opened are loaded in idle time
+        if self.prefetch_id is not None:
+            GLib.source_remove(self.prefetch_id)
+        self.prefetch_ids = self.sidebar.get_neighbour_ids(path)
+        self.prefetch_id = GLib.idle_add(self.prefetch_next, priority=GLib.PRIORITY_LOW)
+
+    def prefetch_next(self):
+        # one note per call so the main loop stays responsive
+        if not self.prefetch_ids:
+            self.prefetch_id = None
+            return False
+        note_id = self.prefetch_ids.pop(0)
+        if note_id != self.editor.note_id and note_id not in self.editor.buffer_cache:
+            self.editor.prefetch(note_id, self.database.get_note_layout(note_id))
+        return True
+
+    @lg.logging_decorator(logger)
+    def search_notes(self, entry):
+        query = entry.get_text().strip()
+        if query == "":
+            self.sidebar.set_filter(None)
+        else:
+            self.sidebar.set_filter(self.database.search(query))
+            self.sidebar.view.expand_all()
+
+    @lg.logging_decorator(logger)
     def save_note(self, event):
-        path = self.sidebar.get_selected()
-        # check if something was selected and that it was not a notebook
-        if path is not None and len(self.sidebar.get_path(path).to_string()) > 1:
-            parent = self.sidebar.get_parent(path)
-            if self.sidebar.store[parent][0] != 'Trash':
-                clean_text = self.editor.get_clean_text()
-                if clean_text != "":
-                    title = self.get_title(clean_text)
+        # Ctrl+S and the save button skip the autosave delay
+        self.autosave.flush()
+
+    @lg.logging_decorator(logger)
+    def get_note_snapshot(self, note_id):
+        # serializes a note that has a buffer in the editor, the shown one or
+        # a cached one, and updates its title in the sidebar. This has to run
+        # on the main thread, the commit does not.
+        # returns None when the note can not be saved
+        if note_id == self.editor.note_id:
+            if self.current_row is None or not self.current_row.valid():
+                return None
+            row = self.sidebar.get_iter_from_path(self.current_row.get_path())
+        else:
+            row = self.sidebar.find_note(note_id)
+        if row is None:
+            return None
+        parent = self.sidebar.get_parent(row)
+        if self.sidebar.get_id(parent) == self.database.get_trash_id():
+            return None
+        text = self.editor.get_note_text(note_id)
+        if text is None:
+            return None
+        clean_text, content = text
+        if clean_text != "":
+            title = self.get_title(clean_text)
+
+        else:
+            title = "New Note"
+
+        self.sidebar.modify_item(self.sidebar.get_path(row), title)
+        return title, content
 
-                else:
-                    title = "New Note"
-
-                content = self.editor.get_text()
-                parent_iter = self.sidebar.get_parent(path)
-                parent_id = self.sidebar.get_id(parent_iter)
-                note_id = self.sidebar.get_id(path)
-                self.database.modify_note(title,content,note_id)
-                self.sidebar.modify_item(path, title)
     @lg.logging_decorator(logger)
     def start_database(self):
-        path = "{}/Noted".format(GLib.get_user_data_dir())
-        if not os.path.exists(path):
-            subprocess.call(['mkdir', path])
+        path = paths.data_dir(create=True)
         db = shelve.open("{}/database.db".format(path))
         self.database = Database()
         self.database.start_database()
@@ -198,51 +323,111 @@ class MainWindow(Gtk.Window):
         else:
             self.id = db['note_id']
             self.notebook_id = db['notebook_id']
+        # notes imported from the command line take ids past the saved counters
+        next_id, next_notebook_id = self.database.get_next_ids()
+        self.id = max(self.id, next_id)
+        self.notebook_id = max(self.notebook_id, next_notebook_id)
+        # notes saved before the search index are indexed in the background
+        # once, search looks at the titles until then. Notes saved before
+        # the content codec are encoded, then the ones saved as GTK tagsets
+        # are converted to the note format and the ones saved without a
+        # summary get it
+        self.contents_indexed = db.get('contents_indexed', False) or not self.database.search_enabled
+        self.database.search_indexed = self.contents_indexed
+        self.contents_encoded = db.get('contents_encoded', False)
+        self.contents_converted = db.get('contents_converted', False)
+        self.contents_summarized = db.get('contents_summarized', False)
+        self.encoder = None
+        if not (self.contents_indexed and self.contents_encoded and self.contents_converted and self.contents_summarized):
+            self.encoder_stop = threading.Event()
+            self.encoder = worker.Worker(self.database.fork, autosave.close_database)
+            self.encoder.start()
+            if not self.contents_indexed:
+                self.encoder.submit(Database.index_all_contents, (self.encoder_stop,), self.on_contents_indexed)
+            if not self.contents_encoded:
+                self.encoder.submit(Database.encode_all_contents, (self.encoder_stop,), self.on_contents_encoded)
+            if not self.contents_converted:
+                self.encoder.submit(Database.convert_all_contents, (self.encoder_stop,), self.on_contents_converted)
+            if not self.contents_summarized:
+                self.encoder.submit(Database.summarize_all_contents, (self.encoder_stop,), self.on_contents_summarized)
+        # the editor loads the stored images of a note as they are scrolled to
+        self.image_worker = worker.Worker(self.database.fork, autosave.close_database)
+        self.image_worker.start()
+        self.editor.get_images = self.get_images
         notebooks = self.database.get_notebooks()
-        #we do two iterations of the notebooks to get the trash first and then the rest.
-        # is there a better way ?
+        # only the notebooks and how many notes they have, the sidebar loads
+        # the notes of a notebook in pages when it is expanded
+        counts = self.database.get_notebook_counts()
+        self.sidebar.get_page = self.database.get_note_page
+        #the notebooks go first and the trash after them.
+        for notebook in notebooks:
+            if notebook.special != migrations.TRASH:
+                self.sidebar.add_notebook(notebook.name, notebook.idd, counts.get(notebook.idd, 0))
         for notebook in notebooks:
-            if notebook.name == 'Trash':
+            if notebook.special == migrations.TRASH:
                 add_trash = False
-                notebook_iter = self.sidebar.add_notebook('Trash', notebook.idd)
-                notes = self.database.get_notes_from_notebook(notebook.idd)
-                for note in notes:
-                    self.sidebar.add_item(note.name,note.idd,notebook_iter)
+                self.sidebar.add_notebook(migrations.TRASH_NAME, notebook.idd, counts.get(notebook.idd, 0))
         if add_trash:
-            self.database.create_notebook('Trash',self.notebook_id)
-            notebook_iter = self.sidebar.add_notebook('Trash', self.notebook_id)
+            self.database.create_notebook(migrations.TRASH_NAME,self.notebook_id,migrations.TRASH)
+            self.sidebar.add_notebook(migrations.TRASH_NAME, self.notebook_id)
             self.notebook_id += 1
-        self.sidebar.get_trash_iter()
-        for notebook in notebooks:
-            if notebook.name != 'Trash':
-                notebook_iter = self.sidebar.add_notebook(notebook.name, notebook.idd)
-                notes = self.database.get_notes_from_notebook(notebook.idd)
-                for note in notes:
-                    self.sidebar.add_item(note.name,note.idd,notebook_iter)
+        self.sidebar.get_trash_iter(self.database.get_trash_id())
         db.close()
 
+    def get_images(self, digests, callback):
+        self.image_worker.submit(image_loader.load_stored, (digests,), callback)
+
     @lg.logging_decorator(logger)
     def close_database(self, event):
-        path = GLib.get_user_data_dir()
-        db = shelve.open("{}/Noted/database.db".format(path))
+        # waits for the images being decoded to go into their buffers and
+        # for the last saves to be written
+        self.editor.image_loader.close(wait=True)
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+        self.autosave.stop()
+        if self.encoder is not None:
+            self.encoder_stop.set()
+            self.encoder.stop()
+        self.image_worker.stop()
+        db = shelve.open("{}/database.db".format(paths.data_dir()))
         db['note_id'] = self.id
         db['notebook_id'] = self.notebook_id
+        db['contents_indexed'] = self.contents_indexed
+        db['contents_encoded'] = self.contents_encoded
+        db['contents_converted'] = self.contents_converted
+        db['contents_summarized'] = self.contents_summarized
         db.close()
+        self.database.maintain(final=True)
         self.database.close_database()
         self.hide()
         Gtk.main_quit()
     @lg.logging_decorator(logger)
-    def get_title(self, content):
+    def on_contents_indexed(self, finished):
+        self.contents_indexed = finished
+        self.database.search_indexed = finished
+        return False
 
-        content = content.lstrip()
-        title_index = content.find("\n")
-        if title_index < 20 and title_index != -1:
-            title = content[:title_index]
-        elif len(content) > 20:
-            title = content[:20]
-        else:
-            title = content
-        return title
+    def on_contents_encoded(self, finished):
+        self.contents_encoded = finished
+        return False
+
+    def on_contents_converted(self, finished):
+        self.contents_converted = finished
+        return False
+
+    def on_contents_summarized(self, finished):
+        self.contents_summarized = finished
+        return False
+
+    @lg.logging_decorator(logger)
+    def maintain_database(self):
+        self.database.maintain()
+        return True
+
+    @lg.logging_decorator(logger)
+    def get_title(self, content):
+        # content is the utf-8 text of the editor, see note_format.get_title
+        return note_format.get_title(content.decode('utf-8')).encode('utf-8')
 
     @lg.logging_decorator(logger)
     def on_button_clicked(self, widget, tag):
@@ -263,10 +448,21 @@ class MainWindow(Gtk.Window):
             self.create_notebook(None)
         elif ctrl and keyval_name == 'q':
             self.close_database(None)
+        elif ctrl and keyval_name == 'D':
+            # Ctrl+Shift+D
+            self.dump_stats()
+
+    def dump_stats(self, *args):
+        # writes the call counts and latencies of the app next to the database,
+        # also bound to SIGUSR1 so it can be asked for from a terminal
+        text_path, json_path = instrumentation.dump(paths.data_dir())
+        self.logger.logger.info('Stats written to {} and {}'.format(text_path, json_path))
+        return True
 
 def start():
     win = MainWindow()
     win.show_all()
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, win.dump_stats)
     Gtk.main()
 
 if __name__=='__main__':
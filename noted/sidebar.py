@@ -1,12 +1,17 @@
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
 from logger import logger as lg
 
+# id of the row that stands in for the notes of a notebook not loaded yet
+PLACEHOLDER = -1
+# notes fetched per page when a notebook is expanded
+PAGE_SIZE = 200
+
 
 class Sidebar(Gtk.VBox):
 
-    logger = lg.Logger()
+    logger = lg.Logger('Sidebar')
 
     def __init__(self):
 
@@ -19,11 +24,34 @@ class Sidebar(Gtk.VBox):
         # TreeStore
         self.store = Gtk.TreeStore(str, int)
 
+        # the notes of a notebook are loaded the first time it is expanded,
+        # until then it has one placeholder row with their count.
+        # get_page(notebook_id, after_id, limit) returns (note id, title) pairs
+        # ordered by id, cursors has the last id loaded of every notebook that
+        # is not loaded completely and counts the notes still to be loaded
+        self.get_page = None
+        self.cursors = {}
+        self.counts = {}
+        self.loading_id = None
+
+        # iters by id, so that rows are found without walking the store.
+        # iters of a TreeStore stay valid as long as their row exists, unlike
+        # TreeRowReferences they cost nothing when other rows change
+        self.notebook_rows = {}
+        self.note_rows = {}
+
+        # the view shows the store through a filter that is used by search.
+        # iters and paths handed out by this class always belong to the store
+        self.visible_notes = None
+        self.visible_notebooks = None
+        self.filter = self.store.filter_new()
+        self.filter.set_visible_func(self.is_visible)
+
         # Renderer
         self.renderer = Gtk.CellRendererText()
 
         # TreeView
-        self.view = Gtk.TreeView(self.store)
+        self.view = Gtk.TreeView(self.filter)
         self.view.set_headers_visible(False)
         # F6F6F5 - grey sidebar
         self.view.modify_bg(Gtk.StateType.NORMAL,
@@ -33,11 +61,14 @@ class Sidebar(Gtk.VBox):
         self.view.modify_fg(Gtk.StateType.SELECTED,
                             Gdk.Color.parse('#ffffff')[1])
         self.view.set_activate_on_single_click(True)
+        self.view.connect('test-expand-row', self.on_expand)
         self.view.append_column(Gtk.TreeViewColumn("Notes",
                                 self.renderer, text=0))
         self.trash_iter = None
         
+        # several notes can be selected to be deleted or restored together
         self.selection = self.view.get_selection()
+        self.selection.set_mode(Gtk.SelectionMode.MULTIPLE)
         
         self.sidebar_options = {}
         self.menu = Gtk.Menu()
@@ -50,6 +81,15 @@ class Sidebar(Gtk.VBox):
         item_restore = Gtk.MenuItem("Restore")
         self.menu.append(item_restore)
         self.sidebar_options['restore'] = item_restore
+        # the notebooks are filled in by set_move_targets when the menu opens
+        item_move = Gtk.MenuItem("Move to")
+        self.move_menu = Gtk.Menu()
+        item_move.set_submenu(self.move_menu)
+        self.menu.append(item_move)
+        self.sidebar_options['move'] = item_move
+        item_empty = Gtk.MenuItem("Empty Trash")
+        self.menu.append(item_empty)
+        self.sidebar_options['empty'] = item_empty
         self.menu.show_all()
         self.menu.attach_to_widget(self.view,None)
         
@@ -57,39 +97,201 @@ class Sidebar(Gtk.VBox):
         self.scrolled_window.add(self.view)
         self.add(self.scrolled_window)
 
+    def is_visible(self, model, tree_iter, data):
+        if self.visible_notes is None:
+            return True
+        if model[tree_iter][1] == PLACEHOLDER:
+            return False
+        if model.iter_depth(tree_iter) == 0:
+            return model[tree_iter][1] in self.visible_notebooks
+        return model[tree_iter][1] in self.visible_notes
+
+    @lg.logging_decorator(logger)
+    def set_filter(self, results):
+        # shows only the notes in results, a list of (note id, notebook id,
+        # title, ...) as returned by Database.search. None shows everything
+        if results is None:
+            self.visible_notes = None
+            self.visible_notebooks = None
+        else:
+            self.visible_notes = set(result[0] for result in results)
+            self.visible_notebooks = set(result[1] for result in results)
+            # the notes found have to be in the store to be shown, the rest of
+            # their notebooks stays paged
+            for note_id, notebook_id, title in (result[:3] for result in results):
+                if note_id not in self.note_rows:
+                    self.add_found(title, note_id, notebook_id)
+        self.filter.refilter()
+
+    def add_found(self, title, note_id, notebook_id):
+        # adds a note of a page that is not loaded yet, load_page skips it
+        notebook_iter = self.find_notebook(notebook_id)
+        if notebook_iter is None:
+            return
+        placeholder = self.get_placeholder(notebook_iter)
+        self.note_rows[note_id] = self.store.insert_before(notebook_iter, placeholder, [title, note_id])
+        if notebook_id in self.counts:
+            self.counts[notebook_id] = max(self.counts[notebook_id] - 1, 0)
+            if placeholder is not None:
+                self.store[placeholder][0] = self.placeholder_text(self.counts[notebook_id])
+
+    @lg.logging_decorator(logger)
+    def to_store_path(self, path):
+        # converts a path of the view to a path of the store
+        return self.filter.convert_path_to_child_path(path)
+
     @lg.logging_decorator(logger)
-    def get_trash_iter(self):
-        for item in self.store:
-            if item[0] == 'Trash':
-                self.trash_iter = item.iter
+    def get_trash_iter(self, trash_id):
+        self.trash_iter = self.find_notebook(trash_id)
+
+    def is_trash(self, tree_iter):
+        # by id, a notebook of the user can be named Trash as well
+        return tree_iter is not None and self.trash_iter is not None and \
+            self.store.iter_depth(tree_iter) == 0 and self.get_id(tree_iter) == self.get_id(self.trash_iter)
 
     @lg.logging_decorator(logger)
-    def add_notebook(self, name, notebook_id):
-        notebook_iter = self.store.append(None, [name, notebook_id])
-        if self.trash_iter != None:
-            self.store.move_before(notebook_iter,self.trash_iter)
+    def add_notebook(self, name, notebook_id, count=0):
+        # count is the number of notes the notebook has in the database, they
+        # are loaded when it is expanded
+        if self.trash_iter is not None:
+            notebook_iter = self.store.insert_before(None, self.trash_iter, [name, notebook_id])
+        else:
+            notebook_iter = self.store.append(None, [name, notebook_id])
+        self.notebook_rows[notebook_id] = notebook_iter
+        if count:
+            self.cursors[notebook_id] = 0
+            self.counts[notebook_id] = count
+            self.store.append(notebook_iter, [self.placeholder_text(count), PLACEHOLDER])
         return notebook_iter
 
+    def placeholder_text(self, count):
+        return '{} notes'.format(count) if count != 1 else '1 note'
+
+    def get_placeholder(self, notebook_iter):
+        # the placeholder is always the last child
+        count = self.store.iter_n_children(notebook_iter)
+        if count:
+            child = self.store.iter_nth_child(notebook_iter, count - 1)
+            if self.store[child][1] == PLACEHOLDER:
+                return child
+        return None
+
+    @lg.logging_decorator(logger)
+    def on_expand(self, view, filter_iter, path):
+        notebook_iter = self.filter.convert_iter_to_child_iter(filter_iter)
+        notebook_id = self.store[notebook_iter][1]
+        if notebook_id in self.cursors:
+            # the first page right away, the rest in idle time
+            self.load_page(notebook_iter)
+            if notebook_id in self.cursors and self.loading_id is None:
+                self.loading_id = GLib.idle_add(self.load_pages, priority=GLib.PRIORITY_LOW)
+        return False
+
+    def load_pages(self):
+        # loads one more page of the first notebook that is expanded but not
+        # loaded completely, one page per call so the main loop stays responsive
+        for notebook_id in list(self.cursors):
+            notebook_iter = self.find_notebook(notebook_id)
+            if notebook_iter is None:
+                del self.cursors[notebook_id]
+                continue
+            path = self.filter.convert_child_path_to_path(self.store.get_path(notebook_iter))
+            if path is not None and self.view.row_expanded(path):
+                self.load_page(notebook_iter)
+                return True
+        self.loading_id = None
+        return False
+
+    @lg.logging_decorator(logger)
+    def load_page(self, notebook_iter):
+        # adds the next page of notes before the placeholder, the placeholder
+        # goes once the last page is loaded
+        notebook_id = self.store[notebook_iter][1]
+        if notebook_id not in self.cursors:
+            return
+        page = self.get_page(notebook_id, self.cursors[notebook_id], PAGE_SIZE)
+        placeholder = self.get_placeholder(notebook_iter)
+        added = 0
+        for note_id, title in page:
+            # a search may have added it already
+            if note_id not in self.note_rows:
+                self.note_rows[note_id] = self.store.insert_before(notebook_iter, placeholder, [title, note_id])
+                added += 1
+        if page:
+            self.cursors[notebook_id] = page[-1][0]
+        self.counts[notebook_id] = max(self.counts[notebook_id] - added, 0)
+        if len(page) < PAGE_SIZE:
+            del self.cursors[notebook_id]
+            del self.counts[notebook_id]
+            if placeholder is not None:
+                self.store.remove(placeholder)
+        elif placeholder is not None:
+            self.store[placeholder][0] = self.placeholder_text(self.counts[notebook_id])
+
+    @lg.logging_decorator(logger)
+    def load_children(self, notebook_iter):
+        # loads every note of the notebook, for changes that need all of them
+        while self.store[notebook_iter][1] in self.cursors:
+            self.load_page(notebook_iter)
+
     @lg.logging_decorator(logger)
     def add_item(self, title, note_id, notebook_iter=None):
         # Adds one item to the store
-        # there is an option to pass notebook iter.
-        # It is used when starting the database
+        # there is an option to pass notebook iter, without it the item goes
+        # to the notebook of the selected row.
         # checks the depth of the iter to avoid making more nested folders
 
         if notebook_iter is None:
-            parent_iter = self.get_selected()
-            if parent_iter is not None and self.store[parent_iter][0] != 'Trash':
-                if self.store.iter_depth(parent_iter) != 0:
-                    parent_iter = self.store.iter_parent(parent_iter)
-                self.store.append(parent_iter, [title, note_id])
-                return True
-        else:
-            if self.store.iter_depth(notebook_iter) == 0:
-                self.store.append(notebook_iter, [title, note_id])
-                return True
+            notebook_iter = self.get_selected()
+            if notebook_iter is None or self.is_trash(notebook_iter):
+                return False
+            if self.store.iter_depth(notebook_iter) != 0:
+                notebook_iter = self.store.iter_parent(notebook_iter)
+        if self.store.iter_depth(notebook_iter) == 0:
+            notebook_id = self.store[notebook_iter][1]
+            if notebook_id in self.cursors and note_id > self.cursors[notebook_id]:
+                # it comes with a page that is not loaded yet
+                self.counts[notebook_id] += 1
+                self.store[self.get_placeholder(notebook_iter)][0] = self.placeholder_text(self.counts[notebook_id])
+            else:
+                self.note_rows[note_id] = self.store.insert_before(notebook_iter, self.get_placeholder(notebook_iter), [title, note_id])
+            return True
         return False
 
+    @lg.logging_decorator(logger)
+    def set_move_targets(self, callback):
+        # one item per notebook but the Trash, callback gets the notebook id
+        for item in self.move_menu.get_children():
+            self.move_menu.remove(item)
+        notebook_iter = self.store.get_iter_first()
+        while notebook_iter is not None:
+            if not self.is_trash(notebook_iter):
+                item = Gtk.MenuItem(self.store[notebook_iter][0])
+                item.connect('activate', callback, self.store[notebook_iter][1])
+                self.move_menu.append(item)
+            notebook_iter = self.store.iter_next(notebook_iter)
+        self.move_menu.show_all()
+
+    @lg.logging_decorator(logger)
+    def move_item(self, item, notebook_iter):
+        # moves the row of a note to another notebook
+        title, note_id = self.store[item][0], self.store[item][1]
+        self.note_rows.pop(note_id, None)
+        self.store.remove(item)
+        self.add_item(title, note_id, notebook_iter)
+
+    @lg.logging_decorator(logger)
+    def remove_children(self, notebook_iter):
+        # removes the notes of a notebook, loaded or not
+        notebook_id = self.store[notebook_iter][1]
+        self.cursors.pop(notebook_id, None)
+        self.counts.pop(notebook_id, None)
+        child = self.store.iter_children(notebook_iter)
+        while child is not None:
+            self.note_rows.pop(self.store[child][1], None)
+            self.store.remove(child)
+            child = self.store.iter_children(notebook_iter)
+
     @lg.logging_decorator(logger)
     def modify_item(self, path, title):
 
@@ -97,12 +299,17 @@ class Sidebar(Gtk.VBox):
             self.store[path][0] = title
 
     @lg.logging_decorator(logger)
-    def remove_item(self):
-
-        item = self.get_selected()
-        if item is not None and self.store[item][0] != 'Trash':
-            if len(self.store.get_path(item).to_string()) > 1:
+    def remove_item(self, item=None):
+        # removes item, the selected row if it is None. The notes go to the trash
+        # unless they are in it already
+        if item is None:
+            item = self.get_selected()
+        if item is not None and self.store[item][1] == PLACEHOLDER:
+            return None
+        if item is not None and not self.is_trash(item):
+            if self.store.iter_depth(item) > 0:
                 note_id = self.store[item][1]
+                self.note_rows.pop(note_id, None)
                 parent_iter = self.store.iter_parent(item)
                 parent_id = self.get_id(parent_iter)
                 if parent_id != self.get_id(self.trash_iter):
@@ -110,12 +317,33 @@ class Sidebar(Gtk.VBox):
             else:
                 parent_id = self.store[item][1]
                 note_id = None
+                self.notebook_rows.pop(parent_id, None)
+                trash_id = self.get_id(self.trash_iter)
+                if self.cursors.get(trash_id) == 0:
+                    # nothing of the trash is loaded, it gets the notes from the
+                    # database when it is expanded. Only its count changes
+                    moved = self.counts.pop(parent_id, 0)
+                    self.cursors.pop(parent_id, None)
+                    child = self.store.iter_children(item)
+                    while child is not None:
+                        if self.store[child][1] != PLACEHOLDER:
+                            self.note_rows.pop(self.store[child][1], None)
+                            moved += 1
+                        child = self.store.iter_next(child)
+                    self.counts[trash_id] += moved
+                    self.store[self.get_placeholder(self.trash_iter)][0] = self.placeholder_text(self.counts[trash_id])
+                    self.store.remove(item)
+                    return note_id, parent_id
+                self.load_children(item)
                 children_amount = self.store.iter_n_children(item)
                 counter = 0
                 current_child = self.store.iter_children(item)
                 while counter < children_amount:
                     title = self.store[current_child][0]
                     idd = self.store[current_child][1]
+                    # the row goes with the notebook, add_item gives the note
+                    # a new one if that part of the trash is loaded
+                    self.note_rows.pop(idd, None)
                     self.add_item(title,idd,self.trash_iter)
                     counter += 1
                     current_child = self.store.iter_next(current_child)
@@ -129,8 +357,34 @@ class Sidebar(Gtk.VBox):
 
     @lg.logging_decorator(logger)
     def get_selected(self):
-        # returns an iter to the selected row
-        return self.view.get_selection().get_selected()[1]
+        # returns a store iter to the selected row, the first one if there are more
+        model, paths = self.selection.get_selected_rows()
+        if not paths:
+            return None
+        return self.store.get_iter(self.to_store_path(paths[0]))
+
+    @lg.logging_decorator(logger)
+    def get_selected_rows(self):
+        # row references in the store to all selected rows, they stay valid
+        # while the rows are moved around
+        model, paths = self.selection.get_selected_rows()
+        paths = [self.to_store_path(path) for path in paths]
+        return [self.get_row_reference(path) for path in paths if self.store[path][1] != PLACEHOLDER]
+
+    @lg.logging_decorator(logger)
+    def find_notebook(self, notebook_id):
+        # store iter of the notebook, None if it is not in the sidebar
+        return self.find_row(self.notebook_rows, notebook_id)
+
+    @lg.logging_decorator(logger)
+    def find_note(self, note_id):
+        # store iter of the note, None if it is not loaded
+        return self.find_row(self.note_rows, note_id)
+
+    def find_row(self, rows, idd):
+        # a copy, the caller may move it
+        tree_iter = rows.get(idd)
+        return tree_iter.copy() if tree_iter is not None else None
 
     @lg.logging_decorator(logger)
     def get_path(self, iter_node):
@@ -142,6 +396,21 @@ class Sidebar(Gtk.VBox):
         # get parent of a selected note
         return self.store.iter_parent(iter_node)
 
+    @lg.logging_decorator(logger)
+    def get_neighbour_ids(self, path):
+        # ids of the rows right after and right before path, on the same level
+        tree_iter = self.store.get_iter(path)
+        ids = []
+        for neighbour in (self.store.iter_next(tree_iter), self.store.iter_previous(tree_iter)):
+            if neighbour is not None and self.store[neighbour][1] != PLACEHOLDER:
+                ids.append(self.store[neighbour][1])
+        return ids
+
+    @lg.logging_decorator(logger)
+    def get_row_reference(self, path):
+        # a reference stays valid while rows around it are added or removed
+        return Gtk.TreeRowReference.new(self.store, path)
+
     @lg.logging_decorator(logger)
     def get_iter_from_path(self, path):
         return self.store.get_iter(path)
@@ -0,0 +1,228 @@
+import json
+import os
+from core import paths
+
+#
+# Undo history of the note in the editor.
+#
+# The newest records are kept in memory up to MAX_BYTES, older ones are
+# written in chunks to a journal file of the note and read back when the
+# records in memory run out. When another note is shown the whole history
+# goes to the journal, it is read back only if the note is undone again.
+#
+# The journal starts with a fingerprint of the buffer the records apply to,
+# a journal whose fingerprint doesn't match the loaded note is dropped.
+#
+# Records added between begin() and end(), the begin-user-action and
+# end-user-action of the buffer, are kept as one Transaction and undone and
+# redone together. GtkTextView wraps every keystroke in its own user action,
+# so pop_recent lends the newest record to a transaction that is still empty
+# and end() puts it back on its own, that is how typing merges.
+#
+
+JOURNAL_DIR = os.path.join(paths.data_dir(), 'undo')
+MAX_BYTES = 2 * 1024 * 1024
+# rough size of a record without its text
+RECORD_OVERHEAD = 64
+FINGERPRINT_LENGTH = 16
+
+record_types = {}
+
+
+def record(cls):
+    # class decorator for the record classes, their __slots__ are what is
+    # written to the journal
+    record_types[cls.__name__] = cls
+    return cls
+
+
+def dump(item):
+    if isinstance(item, Transaction):
+        return ['Transaction', [dump(action) for action in item.actions]]
+    return [type(item).__name__] + [getattr(item, name) for name in type(item).__slots__]
+
+
+def load(values):
+    if values[0] == 'Transaction':
+        return Transaction([load(action) for action in values[1]])
+    cls = record_types[values[0]]
+    item = cls.__new__(cls)
+    for name, value in zip(cls.__slots__, values[1:]):
+        if isinstance(value, unicode):
+            # the buffer gives utf-8 str, json gives unicode back
+            value = value.encode('utf-8')
+        setattr(item, name, value)
+    return item
+
+
+def record_size(item):
+    if isinstance(item, Transaction):
+        return sum(record_size(action) for action in item.actions)
+    text = getattr(item, 'text', None)
+    return RECORD_OVERHEAD + (len(text) if text else 0)
+
+
+def journal_path(note_id):
+    return "{}/{}.journal".format(JOURNAL_DIR, note_id)
+
+
+def remove_journal(note_id):
+    path = journal_path(note_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class Transaction(object):
+    # records of one user action, oldest first
+
+    __slots__ = ('actions', 'mergeable')
+
+    def __init__(self, actions):
+        self.actions = actions
+        self.mergeable = False
+
+
+class Journal(object):
+    # a fingerprint line followed by one JSON line per chunk of records
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        # where every chunk starts
+        self.offsets = []
+        if os.path.exists(path):
+            with open(path, 'rb') as journal:
+                if journal.readline().strip() == fingerprint:
+                    offset = journal.tell()
+                    for line in journal:
+                        self.offsets.append(offset)
+                        offset += len(line)
+            if not self.offsets:
+                os.remove(path)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def push_chunk(self, values):
+        if not os.path.exists(self.path):
+            if not os.path.exists(JOURNAL_DIR):
+                os.makedirs(JOURNAL_DIR)
+            with open(self.path, 'wb') as journal:
+                journal.write('0' * FINGERPRINT_LENGTH + '\n')
+        offset = os.path.getsize(self.path)
+        with open(self.path, 'ab') as journal:
+            journal.write(json.dumps(values) + '\n')
+        self.offsets.append(offset)
+
+    def pop_chunk(self):
+        offset = self.offsets.pop()
+        with open(self.path, 'r+b') as journal:
+            journal.seek(offset)
+            line = journal.read()
+            journal.truncate(offset)
+        if not self.offsets:
+            os.remove(self.path)
+        return json.loads(line)
+
+    def set_fingerprint(self, fingerprint):
+        if os.path.exists(self.path):
+            with open(self.path, 'r+b') as journal:
+                journal.write(fingerprint)
+
+
+class UndoHistory(object):
+    # used like the list it replaces, append and pop from the end
+
+    def __init__(self, path=None, fingerprint=None, max_bytes=MAX_BYTES):
+        self.records = []
+        self.size = 0
+        self.max_bytes = max_bytes
+        self.journal = None
+        if path is not None:
+            self.journal = Journal(path, fingerprint)
+        # user actions can nest, the records go to the outermost one
+        self.depth = 0
+        self.pending = None
+        # how many records at the start of pending were lent by pop_recent
+        self.lent = 0
+
+    def __len__(self):
+        chunks = len(self.journal) if self.journal is not None else 0
+        return len(self.records) + chunks
+
+    def append(self, item):
+        if self.pending is not None:
+            self.pending.append(item)
+            return
+        self.records.append(item)
+        self.size += record_size(item)
+        if self.size > self.max_bytes and len(self.records) > 1:
+            # the older half goes to disk, without a journal it is dropped
+            self.spill(len(self.records) // 2)
+
+    def pop(self):
+        if not self.records and self.journal is not None and len(self.journal):
+            self.records = [load(values) for values in self.journal.pop_chunk()]
+            self.size = sum(record_size(item) for item in self.records)
+        if not self.records:
+            raise IndexError('pop from empty undo history')
+        item = self.records.pop()
+        self.size -= record_size(item)
+        return item
+
+    def pop_recent(self):
+        # pops from the records in memory only, used to merge typing into the
+        # newest record without reading the journal. The caller appends the
+        # record again, merged or not
+        if self.pending:
+            return self.pending.pop()
+        if not self.records:
+            raise IndexError('no undo records in memory')
+        item = self.records.pop()
+        self.size -= record_size(item)
+        if self.pending is not None:
+            self.lent += 1
+        return item
+
+    def begin(self):
+        self.depth += 1
+        if self.depth == 1:
+            self.pending = []
+
+    def end(self, compact=None):
+        # compact is called with the records of the transaction and returns
+        # them with neighbouring ones joined where possible
+        if self.depth == 0:
+            return
+        self.depth -= 1
+        if self.depth:
+            return
+        actions, self.pending = self.pending, None
+        lent, actions = actions[:self.lent], actions[self.lent:]
+        self.lent = 0
+        for item in lent:
+            self.append(item)
+        if compact is not None and len(actions) > 1:
+            actions = compact(actions)
+        if len(actions) == 1:
+            # kept on its own so that typing still merges into it
+            self.append(actions[0])
+        elif actions:
+            self.append(Transaction(actions))
+
+    def spill(self, count):
+        spilled = self.records[:count]
+        self.records = self.records[count:]
+        self.size -= sum(record_size(item) for item in spilled)
+        if self.journal is not None:
+            self.journal.push_chunk([dump(item) for item in spilled])
+
+    def close(self, fingerprint):
+        # called when the note is no longer shown, nothing stays in memory
+        while self.depth:
+            self.end()
+        if self.journal is not None and self.records:
+            self.spill(len(self.records))
+        if self.journal is not None:
+            self.journal.set_fingerprint(fingerprint)
+        self.records = []
+        self.size = 0
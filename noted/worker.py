@@ -0,0 +1,48 @@
+import threading
+import Queue
+from gi.repository import GLib
+from logger import logger as lg
+
+
+class Worker(threading.Thread):
+    # Runs jobs one after the other on a background thread.
+    # setup is called once on the worker thread and its result is passed
+    # as the first argument to every job, this is how a job gets its own
+    # database session. Callbacks are handed back to the GTK main loop.
+
+    logger = lg.Logger('Worker')
+
+    def __init__(self, setup=None, teardown=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.setup = setup
+        self.teardown = teardown
+        self.jobs = Queue.Queue()
+
+    def submit(self, job, args=(), callback=None):
+        self.jobs.put((job, args, callback))
+
+    def run(self):
+        context = None
+        if self.setup is not None:
+            context = self.setup()
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                break
+            job, args, callback = item
+            try:
+                result = job(context, *args)
+            except Exception as e:
+                self.logger.logger.error('There was a problem running the job {} ; ERROR MESSAGE > {}'.format(job.__name__, e))
+                continue
+            if callback is not None:
+                GLib.idle_add(callback, result)
+        if self.teardown is not None:
+            self.teardown(context)
+
+    @lg.logging_decorator(logger)
+    def stop(self):
+        # waits for the queued jobs to finish
+        self.jobs.put(None)
+        self.join()
@@ -16,6 +16,6 @@ setup(  name='Noted',
         description='Take notes with ease',
         url='https://github.com/SuburbanFilth/noted',
         license='GNU GPL2',
-        scripts=['com.github.suburbanfilth.noted'],
-        packages=['noted', 'noted/dialogs', 'noted/logger'],
+        scripts=['com.github.suburbanfilth.noted', 'scripts/noted'],
+        packages=['noted', 'noted/core', 'noted/dialogs', 'noted/logger'],
         data_files=install_data)